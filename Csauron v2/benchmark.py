@@ -0,0 +1,270 @@
+# BENCHMARK.PY
+# Headless benchmarks for the hot paths. Runs on any OS, no window or pywin32 needed.
+#   python benchmark.py --output bench.json
+#   python benchmark.py --quick --output new.json --compare bench.json
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from capture_utils import Template, Logger, ImageSaver, ImageWriterPool, ENCODERS
+from capture_processor import ImageProcessor, ScalePyramid
+
+
+RESOLUTIONS = {
+    '720p': (1280, 720),
+    '1080p': (1920, 1080),
+    '1440p': (2560, 1440),
+    '4k': (3840, 2160),
+}
+SWEEPS = {
+    'v1': np.linspace(0.2, 1.0, 20)[::-1],
+    'v2': np.linspace(0.3, 1.0, 3)[::-1],
+}
+PIXEL_PROBES = [4, 100, 1000]
+
+
+## INPUTS
+def make_frame(width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    noise = rng.integers(0, 256, (height // 16 + 1, width // 16 + 1, 3), dtype=np.uint8)
+    return cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC)
+
+
+def make_templates(img_gray, count, size, seed=0):
+    rng = np.random.default_rng(seed)
+    templates = []
+    for i in range(count):
+        x = int(rng.integers(0, img_gray.shape[1] - size))
+        y = int(rng.integers(0, img_gray.shape[0] - size))
+        templates.append(Template(
+            name=f"bench_{i}.png",
+            image=img_gray[y:y + size, x:x + size].copy(),
+            category='bench',
+            value=0,
+        ))
+    return templates
+
+
+def reset_templates(templates):
+    for template in templates:
+        template.last_match = None
+        template.last_result = None
+        template.track_hits = 0
+        template.track_misses = 0
+
+
+def write_pixel_checks(path, count, width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    checks = [
+        {"range": [[170, 170, 170], [255, 255, 255]], "state": "White"},
+        {"range": [[0, 180, 180], [100, 255, 255]], "state": "Yellow"},
+        {"range": [[0, 0, 150], [100, 100, 255]], "state": "Red"},
+    ]
+    pixel_checks = [
+        {"name": f"probe_{i}", "position": [int(rng.integers(0, width)), int(rng.integers(0, height))], "checks": checks}
+        for i in range(count)
+    ]
+    with open(path, 'w') as f:
+        json.dump({"pixel_checks": pixel_checks}, f)
+
+
+## TIMING
+def time_call(fn, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.fmean(times),
+        "repeat": repeat,
+    }
+
+
+def record(results, bench, params, timing):
+    key = bench + "[" + ",".join(f"{k}={v}" for k, v in params.items()) + "]"
+    results.append({"key": key, "bench": bench, "params": params, "seconds": timing})
+    print(f"{key}: median {timing['median'] * 1000:.2f} ms")
+
+
+## BENCHMARKS
+def bench_matching(results, args, workdir):
+    checks_file = os.path.join(workdir, 'pixel_checks.json')
+    write_pixel_checks(checks_file, 4, 1280, 720)
+    for resolution, sweep, size, count in itertools.product(args.resolutions, args.sweeps, args.template_sizes, args.template_counts):
+        width, height = RESOLUTIONS[resolution]
+        img_gray = cv2.cvtColor(make_frame(width, height), cv2.COLOR_BGR2GRAY)
+        templates = make_templates(img_gray, count, size)
+        processor = ImageProcessor(0.8, checks_file, scales=SWEEPS[sweep])
+        params = {"resolution": resolution, "sweep": sweep, "template_size": size, "templates": count}
+
+        # Cold: full scale sweep for every template
+        timing = time_call(
+            lambda: processor.match_templates(ScalePyramid(img_gray, processor.scales), templates),
+            args.repeat, setup=lambda: reset_templates(templates))
+        record(results, "match_templates_cold", params, timing)
+
+        # Warm: every template is found again through its tracked position
+        timing = time_call(
+            lambda: processor.match_templates(ScalePyramid(img_gray, processor.scales), templates),
+            args.repeat)
+        record(results, "match_templates_tracked", params, timing)
+        processor.executor.shutdown(wait=False)
+
+        # Cold again with the batched FFT engine, the templates all share one size
+        processor = ImageProcessor(0.8, checks_file, scales=SWEEPS[sweep], match_engine='fft')
+        timing = time_call(
+            lambda: processor.match_templates(ScalePyramid(img_gray, processor.scales), templates),
+            args.repeat, setup=lambda: reset_templates(templates))
+        record(results, "match_templates_fft_cold", params, timing)
+        processor.executor.shutdown(wait=False)
+
+
+def bench_pixels(results, args, workdir):
+    checks_file = os.path.join(workdir, 'pixel_checks.json')
+    for resolution, probes in itertools.product(args.resolutions, PIXEL_PROBES):
+        width, height = RESOLUTIONS[resolution]
+        img_cv = make_frame(width, height)
+        write_pixel_checks(checks_file, probes, width, height)
+        processor = ImageProcessor(0.8, checks_file)
+        timing = time_call(lambda: processor.check_pixels(img_cv), args.repeat)
+        record(results, "check_pixels", {"resolution": resolution, "probes": probes}, timing)
+        processor.executor.shutdown(wait=False)
+
+
+def bench_changes(results, args, workdir):
+    checks_file = os.path.join(workdir, 'pixel_checks.json')
+    write_pixel_checks(checks_file, 4, 1280, 720)
+    for resolution in args.resolutions:
+        width, height = RESOLUTIONS[resolution]
+        frames = [cv2.cvtColor(make_frame(width, height, seed), cv2.COLOR_BGR2GRAY) for seed in range(2)]
+        processor = ImageProcessor(0.8, checks_file)
+        processor.detect_changes(frames[1])
+        counter = itertools.count()
+        timing = time_call(lambda: processor.detect_changes(frames[next(counter) % 2]), args.repeat)
+        record(results, "detect_changes", {"resolution": resolution}, timing)
+        processor.executor.shutdown(wait=False)
+
+
+def bench_logger(results, args, workdir):
+    logger = Logger(os.path.join(workdir, 'match_log.txt'))
+    for count in args.template_counts:
+        log_entries = [
+            f"Conf: 0.9000\nHC: bench_{i}.png Scale: 1.00\nCategory: bench\nValue: 0\n"
+            f"Pos: (10, 10):(74, 74)\nAbs: (10, 10):(74, 74)"
+            for i in range(count)
+        ]
+        timing = time_call(lambda: logger.write_log(time.time(), log_entries), args.repeat)
+        record(results, "write_log", {"templates": count}, timing)
+    logger.close()
+
+
+def bench_saver(results, args, workdir):
+    # Time on the processing thread, the encoding happens in the writer pool
+    image_writer = ImageWriterPool()
+    image_saver = ImageSaver(image_writer=image_writer)
+    for resolution in args.resolutions:
+        width, height = RESOLUTIONS[resolution]
+        img_cv = make_frame(width, height)
+        timing = time_call(lambda: image_saver.save_processed_image(time.time(), img_cv), args.repeat)
+        record(results, "save_processed_image", {"resolution": resolution}, timing)
+    image_writer.close()
+
+
+def bench_encoders(results, args, workdir):
+    for resolution, image_format in itertools.product(args.resolutions, ENCODERS):
+        width, height = RESOLUTIONS[resolution]
+        img_cv = make_frame(width, height)
+        image_writer = ImageWriterPool(image_format, workers=0)
+        timing = time_call(lambda: image_writer.encode(img_cv), args.repeat)
+        record(results, "encode_image", {"resolution": resolution, "format": image_format}, timing)
+
+
+## COMPARISON
+def compare(results, baseline_file, threshold):
+    with open(baseline_file, 'r') as f:
+        baseline = {entry["key"]: entry for entry in json.load(f)["results"]}
+
+    regressions = 0
+    for entry in results:
+        old = baseline.get(entry["key"])
+        if old is None:
+            continue
+        ratio = entry["seconds"]["median"] / old["seconds"]["median"]
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{entry['key']}: {ratio:.2f}x of baseline{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark matching, pixel checks, change detection, logging and saving.")
+    parser.add_argument('--resolutions', nargs='+', default=list(RESOLUTIONS), choices=list(RESOLUTIONS))
+    parser.add_argument('--template-counts', nargs='+', type=int, default=[1, 10, 100])
+    parser.add_argument('--template-sizes', nargs='+', type=int, default=[32, 96])
+    parser.add_argument('--sweeps', nargs='+', default=list(SWEEPS), choices=list(SWEEPS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--quick', action='store_true', help="720p and 1080p, 1 and 10 templates of 64px, one repeat")
+    parser.add_argument('--output', default='bench.json')
+    parser.add_argument('--compare', help="Previous JSON output to compare against")
+    parser.add_argument('--threshold', type=float, default=0.10, help="Slowdown ratio reported as a regression")
+    args = parser.parse_args()
+
+    if args.quick:
+        args.resolutions = ['720p', '1080p']
+        args.template_counts = [1, 10]
+        args.template_sizes = [64]
+        args.repeat = 1
+
+    results = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        # ImageSaver writes into ./processed
+        os.chdir(workdir)
+        try:
+            bench_matching(results, args, workdir)
+            bench_pixels(results, args, workdir)
+            bench_changes(results, args, workdir)
+            bench_logger(results, args, workdir)
+            bench_saver(results, args, workdir)
+            bench_encoders(results, args, workdir)
+        finally:
+            os.chdir(cwd)
+
+    output = {
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,61 +3,344 @@
 import numpy as np
 import cv2
 import json
+import os
 import time
+import threading
 from concurrent.futures import ThreadPoolExecutor
 
+from metrics import METRICS
+from fft_match import FFTMatchEngine, MIN_BUCKET
+
+
+DEFAULT_SCALES = np.linspace(0.3, 1.0, 3)[::-1]
+COARSE_CANDIDATES = 3
+COARSE_MIN_SIZE = 6
+TRACK_MARGIN = 0.5
+TRACK_MIN_MARGIN = 16
+TRACK_SCALE_STEP = 0.05
+TILE_GRID = (32, 18)
+TILE_THRESHOLD = 8
+# Change detection runs on a frame downsampled to this many pixels per tile side,
+# differences up to CHANGE_NOISE (0-255) are treated as capture noise
+CHANGE_TILE_SIZE = 10
+CHANGE_NOISE = 4
+# Boxes overlapping more than this (intersection over union) are the same instance
+NMS_OVERLAP = 0.3
+# Peaks kept per scale before merging, relative to max_instances
+PEAK_OVERSAMPLE = 2
+
+
+def region_box(region, width, height):
+    # Window fractions to (x0, y0, x1, y1) window pixels, at least one pixel
+    x0, y0 = min(width - 1, int(region[0] * width)), min(height - 1, int(region[1] * height))
+    x1, y1 = int(np.ceil(region[2] * width)), int(np.ceil(region[3] * height))
+    return x0, y0, max(x0 + 1, x1), max(y0 + 1, y1)
+
+
+def offset_match(match_result, dx, dy):
+    # Region coordinates back to frame coordinates, for one match or a list of instances
+    if not match_result or (dx, dy) == (0, 0):
+        return match_result
+    if isinstance(match_result, list):
+        return [offset_match(instance, dx, dy) for instance in match_result]
+    startX, startY, endX, endY, scale, confidence = match_result
+    return startX + dx, startY + dy, endX + dx, endY + dy, scale, confidence
+
+
+## SCALE PYRAMID
+# Built once per frame and shared read-only by every template, templates are matched on
+# several threads so levels are built under the lock.
+# crop is the frame's (x0, y0, window width, window height) for partial captures.
+class ScalePyramid:
+    def __init__(self, img_gray, scales, crop=None):
+        self.img_gray = img_gray
+        self.scales = scales
+        self.crop = crop
+        self.levels = {}
+        self.coarse_levels = {}
+        # Sub-pyramids of template regions, shared by templates with the same region
+        self.regions = {}
+        self.requests = 0
+        # Skipped by worker processes matching on their own pyramids of this frame
+        self.worker_skipped = 0
+        self.lock = threading.Lock()
+
+    def level(self, index):
+        with self.lock:
+            self.requests += 1
+            if index not in self.levels:
+                scale = self.scales[index]
+                resized = cv2.resize(self.img_gray, (int(self.img_gray.shape[1] * scale), int(self.img_gray.shape[0] * scale)))
+                resized.flags.writeable = False
+                r = self.img_gray.shape[1] / float(resized.shape[1])
+                self.levels[index] = (resized, r)
+            return self.levels[index]
+
+    def coarse_level(self, index, factor):
+        key = (index, factor)
+        with self.lock:
+            self.requests += 1
+            if key not in self.coarse_levels:
+                scale = self.scales[index] * factor
+                size = (max(1, int(self.img_gray.shape[1] * scale)), max(1, int(self.img_gray.shape[0] * scale)))
+                coarse = cv2.resize(self.img_gray, size, interpolation=cv2.INTER_AREA)
+                coarse.flags.writeable = False
+                r = self.img_gray.shape[1] / float(coarse.shape[1])
+                self.coarse_levels[key] = (coarse, r)
+            return self.coarse_levels[key]
+
+    def region(self, region):
+        # Returns (pyramid over the region, (dx, dy) of the region in the frame)
+        if region is None:
+            return self, (0, 0)
+        with self.lock:
+            if region not in self.regions:
+                height, width = self.img_gray.shape[:2]
+                x, y, window_width, window_height = self.crop if self.crop is not None else (0, 0, width, height)
+                x0, y0, x1, y1 = region_box(region, window_width, window_height)
+                x0, y0 = min(max(0, x0 - x), width - 1), min(max(0, y0 - y), height - 1)
+                x1, y1 = max(x0 + 1, min(width, x1 - x)), max(y0 + 1, min(height, y1 - y))
+                self.regions[region] = (ScalePyramid(self.img_gray[y0:y1, x0:x1], self.scales), (x0, y0))
+            return self.regions[region]
+
+    @property
+    def resizes_skipped(self):
+        skipped = self.requests - len(self.levels) - len(self.coarse_levels) + self.worker_skipped
+        return skipped + sum(pyramid.resizes_skipped for pyramid, _ in self.regions.values())
+
+    def release(self):
+        for pyramid, _ in self.regions.values():
+            pyramid.release()
+        self.regions.clear()
+        self.levels.clear()
+        self.coarse_levels.clear()
+        self.img_gray = None
+
+
+## COMPILED PIXEL CHECKS
+# pixel_checks.json packed once into arrays, a frame is then classified with one gather
+# and one broadcast comparison. Unused range slots never match.
+class PixelCheckEngine:
+    def __init__(self, pixel_checks, radius=0):
+        self.names = [check['name'] for check in pixel_checks]
+        self.radius = radius
+        count = len(pixel_checks)
+        slots = max([len(check['checks']) for check in pixel_checks] + [1])
+
+        positions = np.array([check['position'] for check in pixel_checks], dtype=np.intp).reshape(count, 2)
+        self.xs, self.ys = positions[:, 0], positions[:, 1]
+        self.lower = np.full((count, slots, 3), 256, dtype=np.int16)
+        self.upper = np.full((count, slots, 3), -1, dtype=np.int16)
+        # Extra two columns hold the DEAD and Unknown labels
+        self.labels = np.full((count, slots + 2), "Unknown", dtype=object)
+        self.labels[:, slots] = "DEAD"
+        for i, check in enumerate(pixel_checks):
+            for j, color_check in enumerate(check['checks']):
+                self.lower[i, j], self.upper[i, j] = color_check['range']
+                self.labels[i, j] = color_check['state']
+
+        offsets = np.arange(-radius, radius + 1)
+        self.offset_xs, self.offset_ys = [grid.ravel() for grid in np.meshgrid(offsets, offsets)]
+
+    def __len__(self):
+        return len(self.names)
+
+    def sample(self, img_cv, origin=(0, 0)):
+        # Positions are window pixels, origin is where the frame starts in the window
+        height, width = img_cv.shape[:2]
+        frame_xs, frame_ys = self.xs - origin[0], self.ys - origin[1]
+        inside = (frame_xs >= 0) & (frame_xs < width) & (frame_ys >= 0) & (frame_ys < height)
+        if self.radius == 0:
+            colors = img_cv[np.clip(frame_ys, 0, height - 1), np.clip(frame_xs, 0, width - 1), :3]
+        else:
+            # Average a (2r+1)x(2r+1) area around each probe, clipped to the frame
+            ys = np.clip(frame_ys[:, None] + self.offset_ys, 0, height - 1)
+            xs = np.clip(frame_xs[:, None] + self.offset_xs, 0, width - 1)
+            colors = img_cv[ys, xs, :3].mean(axis=1)
+        return colors, inside
+
+    def bounds(self):
+        # (x0, y0, x1, y1) window pixels covering every probe and its averaging area, None without probes
+        if not self.names:
+            return None
+        r = self.radius
+        return int(self.xs.min()) - r, int(self.ys.min()) - r, int(self.xs.max()) + r + 1, int(self.ys.max()) + r + 1
+
+    def classify(self, img_cv, origin=(0, 0)):
+        if not self.names:
+            return []
+        colors, inside = self.sample(img_cv, origin)
+        in_range = np.all((colors[:, None, :] >= self.lower) & (colors[:, None, :] <= self.upper), axis=2)
+        slots = in_range.shape[1]
+        dead = np.all(colors == 0, axis=1)
+        index = np.where(in_range.any(axis=1), in_range.argmax(axis=1), np.where(dead, slots, slots + 1))
+        # Probes outside the window (after a resize) stay Unknown
+        index[~inside] = slots + 1
+        return list(self.labels[np.arange(len(index)), index])
+
+
+## FRAME BUFFERS
+# Conversion targets reused across frames of the same size, one set per processing thread
+class FrameBuffers:
+    def __init__(self):
+        self.local = threading.local()
+
+    def get(self, name, shape, stats):
+        if not hasattr(self.local, 'buffers'):
+            self.local.buffers = {}
+        buffer = self.local.buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, dtype=np.uint8)
+            self.local.buffers[name] = buffer
+            stats['allocs'] += 1
+        return buffer
+
+
+## CHANGE DETECTION
+# Compares small area-averaged frames, cost does not depend on the window size.
+# heatmap is the mean difference (0-255, noise removed) of each tile of the grid.
+class ChangeDetector:
+    def __init__(self, grid=TILE_GRID, tile_threshold=TILE_THRESHOLD, noise_threshold=CHANGE_NOISE):
+        self.grid = tuple(grid)
+        self.tile_threshold = tile_threshold
+        self.noise_threshold = noise_threshold
+        self.size = (self.grid[0] * CHANGE_TILE_SIZE, self.grid[1] * CHANGE_TILE_SIZE)
+        self.previous = None
+        self.current = np.empty(self.size[::-1], dtype=np.uint8)
+        self.diff = np.empty(self.size[::-1], dtype=np.uint8)
+        self.frame_shape = None
+        self.heatmap = None
+
+    def update(self, img_gray):
+        # Returns (change percentage, hot tile mask), both None on the first frame
+        cv2.resize(img_gray, self.size, dst=self.current, interpolation=cv2.INTER_AREA)
+        change_percentage, hot_tiles = None, None
+        if self.previous is not None:
+            cv2.absdiff(self.previous, self.current, dst=self.diff)
+            cv2.threshold(self.diff, self.noise_threshold, 0, cv2.THRESH_TOZERO, dst=self.diff)
+            self.heatmap = cv2.resize(self.diff, self.grid, interpolation=cv2.INTER_AREA).astype(np.float32)
+            change_percentage = float(self.heatmap.mean() / 255 * 100)
+            # A resized window invalidates every cached result, so no tile mask is returned
+            if img_gray.shape == self.frame_shape:
+                hot_tiles = self.heatmap > self.tile_threshold
+        else:
+            self.previous = np.empty_like(self.current)
+        # The two small buffers swap roles, nothing is copied
+        self.previous, self.current = self.current, self.previous
+        self.frame_shape = img_gray.shape
+        return change_percentage, hot_tiles
+
+
+## MULTI-INSTANCE
+def non_max_suppression(boxes, scores, overlap, limit):
+    # Greedy: keep the best box, drop everything overlapping it, repeat
+    x1, y1, x2, y2 = boxes.T
+    areas = (x2 - x1) * (y2 - y1)
+    order = np.argsort(scores)[::-1]
+    keep = []
+    while order.size and len(keep) < limit:
+        best, rest = order[0], order[1:]
+        keep.append(best)
+        width = np.clip(np.minimum(x2[best], x2[rest]) - np.maximum(x1[best], x1[rest]), 0, None)
+        height = np.clip(np.minimum(y2[best], y2[rest]) - np.maximum(y1[best], y1[rest]), 0, None)
+        intersection = width * height
+        order = rest[intersection <= overlap * (areas[best] + areas[rest] - intersection)]
+    return keep
 
 
 ## MAIN PROCESSOR
 class ImageProcessor:
-    def __init__(self, confidence_threshold, pixel_checks_file='pixel_checks.json'):
+    def __init__(self, confidence_threshold, pixel_checks_file='pixel_checks.json', scales=None,
+                 tile_grid=TILE_GRID, tile_threshold=TILE_THRESHOLD, match_engine='opencv', noise_threshold=CHANGE_NOISE):
         self.confidence_threshold = confidence_threshold
+        self.pixel_checks_file = pixel_checks_file
         self.pixel_checks = self.load_pixel_checks(pixel_checks_file)
-
-        self.previous_frame = None
+        self.scales = DEFAULT_SCALES if scales is None else np.asarray(scales)
+        self.change_detector = ChangeDetector(tile_grid, tile_threshold, noise_threshold)
+        self.change_lock = threading.Lock()
+        self.buffers = FrameBuffers()
+        # Window position of the last frame's top-left pixel, tracking restarts when it moves
+        self.origin = (0, 0)
         
         #self.dqn_image = None
 
         self.executor = ThreadPoolExecutor(max_workers=8)
+        # Optional ProcessMatchPool, templates are then matched in worker processes
+        self.match_pool = None
+        # 'fft' matches full searches of same-size templates together
+        self.fft_engine = FFTMatchEngine() if match_engine == 'fft' else None
 
     def load_pixel_checks(self, file_path):
+        if file_path is None:
+            self.pixel_check_specs = {}
+            return PixelCheckEngine([])
+        mtime = os.stat(file_path).st_mtime_ns
         with open(file_path, 'r') as f:
             data = json.load(f)
-        return data['pixel_checks']
+        radius = data.get('radius', 0)
+        engine = PixelCheckEngine(data['pixel_checks'], radius=radius)
+        # Set only once the file parsed, a half-written file is retried on its next change
+        self.pixel_checks_mtime = mtime
+        # The radius applies to every check, a change of it counts for all of them
+        self.pixel_check_specs = {check['name']: (check, radius) for check in data['pixel_checks']}
+        return engine
+
+    def reload_pixel_checks(self):
+        # Returns the number of added, changed or removed checks, None when the file did not change
+        if self.pixel_checks_file is None or os.stat(self.pixel_checks_file).st_mtime_ns == self.pixel_checks_mtime:
+            return None
+        old_specs = self.pixel_check_specs
+        # The engine is a few small arrays, it is rebuilt whole and swapped in one assignment
+        self.pixel_checks = self.load_pixel_checks(self.pixel_checks_file)
+        return sum(old_specs.get(name) != spec for name, spec in self.pixel_check_specs.items()) + len(old_specs.keys() - self.pixel_check_specs.keys())
     
 ## COLORS
-    def check_pixels(self, img_cv):
-        results = []
-        for check in self.pixel_checks:
-            x, y = check["position"]
-            color = img_cv[y, x]
-            
-            ranges = np.array([check["range"] for check in check["checks"]])
-            lower_bounds = ranges[:, 0]
-            upper_bounds = ranges[:, 1]
-            
-            # Vectorized comparison
-            matches = np.all((color >= lower_bounds) & (color <= upper_bounds), axis=1)
-            
-            if np.any(matches):
-                state = check["checks"][np.where(matches)[0][0]]["state"]
-            elif np.all(color == [0, 0, 0]):
-                state = "DEAD"
-            else:
-                state = "Unknown"
-            
-            results.append(f"{check['name']}: {state}\n")
+    def check_pixels(self, img_cv, origin=(0, 0)):
+        # One read of the attribute, a reload can swap the engine at any time
+        pixel_checks = self.pixel_checks
+        # (name, state) in file order, names are not required to be unique
+        return list(zip(pixel_checks.names, pixel_checks.classify(img_cv, origin)))
 
-        return results
+## CAPTURE AREA
+    def capture_box(self, window_size, templates):
+        # Union of every template region and pixel probe as (x0, y0, x1, y1) window pixels.
+        # None when a template searches the whole window, or the union is the whole window anyway
+        width, height = window_size
+        boxes = []
+        for template in templates:
+            if template.region is None:
+                return None
+            boxes.append(region_box(template.region, width, height))
+        probes = self.pixel_checks.bounds()
+        if probes is not None:
+            boxes.append(probes)
+        if not boxes:
+            return None
+        x0, y0 = max(0, min(box[0] for box in boxes)), max(0, min(box[1] for box in boxes))
+        x1, y1 = min(width, max(box[2] for box in boxes)), min(height, max(box[3] for box in boxes))
+        if x1 <= x0 or y1 <= y0 or (x0, y0, x1, y1) == (0, 0, width, height):
+            return None
+        return x0, y0, x1, y1
 
 
 # MAIN FLOW
-    def process_image(self, img, window_position, templates):
+    def process_image(self, img, window_position, templates, crop=None):
         timestamp = time.time()
         log_entries = []
 
-# CONVERT FROM RGB TO BGR
-        img_cv = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
+        origin = crop[:2] if crop is not None else (0, 0)
+        if origin != self.origin:
+            # Tracked and cached positions are frame pixels, they shifted with the capture box
+            for template in templates:
+                template.last_match = None
+                template.last_result = None
+            self.origin = origin
+
+# CONVERT TO GRAY, NOTHING ELSE NEEDS A CONVERTED COLOUR FRAME
+        # Full-frame buffer allocations and copies for this frame
+        stats = {'allocs': 0, 'copies': 0}
+        with METRICS.timer('convert'):
+            img_gray = self.convert_frame(img, stats)
 
 # CREATE DQN VERSION
         #self.dqn_image = cv2.resize(img_cv, (480, 270)) Resize for DQN
@@ -67,90 +350,228 @@ class ImageProcessor:
             #self.dqn_image = self.dqn_image.astype(np.float32) / 255.0  # Normalize to [0, 1]
             #self.dqn_image = np.transpose(self.dqn_image, (2, 0, 1))  # Change to (channels, height, width)
 
-        # Add modular pixel checking here
-        pixel_check_results = self.check_pixels(img_cv)
-        log_entries.extend(pixel_check_results)
+        # Add modular pixel checking here, probes read the BGR(A) frame as it came in
+        with METRICS.timer('pixel_checks'):
+            pixel_states = self.check_pixels(img, origin)
+        log_entries.extend(f"{name}: {state}\n" for name, state in pixel_states)
 
-# CREATE GRAYSCALED
-        img_gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY)
+        # Change detection, its tile mask decides which templates need matching again
+        with METRICS.timer('change_detection'):
+            change_percentage, change_mask = self.detect_changes(img_gray)
         
         # Template matching
-        template_results = self.match_templates(img_gray, templates)
+        pyramid = ScalePyramid(img_gray, self.scales, crop)
+        template_results = self.match_templates(pyramid, templates, change_mask)
+        # Boxes to draw if the frame is saved, see draw_annotations
+        annotations = []
         for result in template_results:
-            log_entries.extend(self.process_template_result(result, window_position, img_cv))
+            log_entries.extend(self.process_template_result(result, window_position, annotations, origin))
+        cached_count = len({result[0].name for result in template_results if result[-1]})
+        log_entries.append(f"RS: {pyramid.resizes_skipped}")
+        log_entries.append(f"Cached: {cached_count}/{len(templates)}")
         
-        # Change detection
-        change_log = self.detect_changes(img_gray)
-        if change_log:
-            log_entries.append(change_log)
+        if change_percentage is not None:
+            log_entries.append(f"CS: {change_percentage:.2f}%")
+        hot_tiles = int(change_mask.sum()) if change_mask is not None else None
+        if hot_tiles is not None:
+            log_entries.append(f"HT: {hot_tiles}/{change_mask.size}")
+        log_entries.append(f"FB: {stats['allocs']} allocs, {stats['copies']} copies")
+        if crop is not None:
+            log_entries.append(f"Crop: ({origin[0]}, {origin[1]}):({origin[0] + img.shape[1]}, {origin[1] + img.shape[0]}) of {crop[2]}x{crop[3]}")
+
+        # Same content with typed fields, for the structured log
+        record = {
+            "timestamp": timestamp,
+            "window_position": [int(window_position[0]), int(window_position[1])],
+            "pixel_checks": [{"name": name, "state": state} for name, state in pixel_states],
+            "templates": [self.template_record(result, window_position, origin) for result in template_results],
+            "change": change_percentage,
+            "hot_tiles": hot_tiles,
+            "resizes_skipped": pyramid.resizes_skipped,
+            "cached": cached_count,
+            "allocs": stats['allocs'],
+            "copies": stats['copies'],
+            "crop": [origin[0], origin[1], origin[0] + img.shape[1], origin[1] + img.shape[0]] if crop is not None else None,
+        }
+        pyramid.release()
+
+        return timestamp, img, log_entries, record, annotations
 
-        return timestamp, img_cv, log_entries
+    def convert_frame(self, img, stats):
+        # Frames are BGRA views over the capture buffer, or BGR from offline sources
+        height, width = img.shape[:2]
+        gray_code = cv2.COLOR_BGRA2GRAY if img.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+        img_gray = cv2.cvtColor(img, gray_code, dst=self.buffers.get('gray', (height, width), stats))
+        stats['copies'] += 1
+        return img_gray
 
 ## SECONDARIES
-    def match_templates(self, img_gray, templates):
+    def match_templates(self, pyramid, templates, change_mask=None):
+        cached = [self.is_unchanged(template, pyramid.img_gray.shape, change_mask) for template in templates]
+        pending = [template for template, is_cached in zip(templates, cached) if not is_cached]
+
+        if self.match_pool is not None and pending:
+            # Per-template timings come back with the results and are recorded here
+            with METRICS.timer('match_pool', templates=len(pending)):
+                matched, pyramid.worker_skipped = self.match_pool.match_templates(pyramid.img_gray, pending, pyramid.crop)
+        else:
+            matched = self.match_pending(pyramid, pending)
+
         results = []
-        for template in templates:
-            match_result = self.match_template(img_gray, template.image)
-            if match_result:
-                results.append((template, *match_result))
+        for template, is_cached in zip(templates, cached):
+            if not is_cached:
+                template.last_result = matched[template.name]
+            # One result per instance, multi-instance templates can have several or none
+            match_results = template.last_result if template.max_instances > 1 else [template.last_result]
+            results.extend((template, *match_result, is_cached) for match_result in match_results if match_result)
         return results
+
+    def match_pending(self, pyramid, templates):
+        if self.fft_engine is None:
+            # cv2.matchTemplate releases the GIL, the templates of a frame are matched on the executor.
+            # A worker only writes its own template's tracking state, the shared pyramid is locked
+            futures = {template.name: self.executor.submit(self.match_single, pyramid, template) for template in templates}
+            return {name: future.result() for name, future in futures.items()}
+
+        # Tracked and coarse templates as usual, the remaining full searches batched by size
+        matched = {}
+        buckets = {}
+        for template in templates:
+            if template.max_instances > 1:
+                matched[template.name] = self.match_single(pyramid, template)
+                continue
+            match_result = self.track_template(pyramid.img_gray, template)
+            if match_result is None and template.search != 'coarse':
+                buckets.setdefault((template.image.shape[:2], template.region), []).append(template)
+                continue
+            if match_result is None:
+                region_pyramid, (dx, dy) = pyramid.region(template.region)
+                match_result = offset_match(self.match_template_coarse(region_pyramid, template), dx, dy)
+                self.update_track(template, match_result)
+            matched[template.name] = match_result
+
+        for (_, region), bucket in buckets.items():
+            region_pyramid, (dx, dy) = pyramid.region(region)
+            if len(bucket) >= MIN_BUCKET:
+                bucket_results = self.fft_engine.match(region_pyramid, bucket)
+            else:
+                bucket_results = [self.match_template(region_pyramid, template.image, template.name) for template in bucket]
+            for template, match_result in zip(bucket, bucket_results):
+                match_result = offset_match(match_result, dx, dy)
+                self.update_track(template, match_result)
+                matched[template.name] = match_result
+        return matched
+
+    def match_single(self, pyramid, template):
+        start_time = time.perf_counter()
+        # Sweeps only cover the template's region, tracking searches around the last match in the frame
+        region_pyramid, (dx, dy) = pyramid.region(template.region)
+        if template.max_instances > 1:
+            # Instances are not tracked, every match is a full sweep
+            match_result = offset_match(self.match_instances(region_pyramid, template), dx, dy)
+        else:
+            match_result = self.track_template(pyramid.img_gray, template)
+        if match_result is None:
+            if template.search == 'coarse':
+                match_result = self.match_template_coarse(region_pyramid, template)
+            else:
+                match_result = self.match_template(region_pyramid, template.image, template.name)
+            match_result = offset_match(match_result, dx, dy)
+            self.update_track(template, match_result)
+        METRICS.observe('match', time.perf_counter() - start_time, template=template.name)
+        return match_result
     
-    def process_template_result(self, result, window_position, img_cv):
-        template, startX, startY, endX, endY, scale, confidence = result
+    def process_template_result(self, result, window_position, annotations, origin=(0, 0)):
+        template, frameX, frameY, frame_endX, frame_endY, scale, confidence, cached = result
+        cached_note = " (cached)" if cached else ""
+        # Logged positions are window pixels, the frame may only cover part of the window
+        startX, startY = origin[0] + frameX, origin[1] + frameY
+        endX, endY = origin[0] + frame_endX, origin[1] + frame_endY
         abs_startX, abs_startY = window_position[0] + startX, window_position[1] + startY
         abs_endX, abs_endY = window_position[0] + endX, window_position[1] + endY
         
         log_entries = []
         if confidence >= self.confidence_threshold:
-            cv2.rectangle(img_cv, (startX, startY), (endX, endY), (0, 255, 0), 1)
+            annotations.append(('rectangle', (frameX, frameY), (frame_endX, frame_endY), (0, 255, 0), 1))
             log_entries.append(
                 f"Conf: {confidence:.4f}\n"
-                f"HC: {template.name} Scale: {scale:.2f}\n"
+                f"HC: {template.name} Scale: {scale:.2f}{cached_note}\n"
                 f"Category: {template.category}\n"
                 f"Value: {template.value}\n"
                 f"Pos: ({startX}, {startY}):({endX}, {endY})\n"
-                f"Abs: ({abs_startX}, {abs_startY}):({abs_endX}, {abs_endY})"
+                f"Abs: ({abs_startX}, {abs_startY}):({abs_endX}, {abs_endY})\n"
+                f"Track: {template.track_hits} hits, {template.track_misses} misses"
             )
             print(f"High confidence detected: {template.name} (Confidence: {confidence:.4f})")
         else:
-            cv2.rectangle(img_cv, (startX, startY), (endX, endY), (0, 0, 255), 1)
+            annotations.append(('rectangle', (frameX, frameY), (frame_endX, frame_endY), (0, 0, 255), 1))
             log_entries.append(
                 f"Conf: {confidence:.4f}\n"
-                f"LC: {template.name} Scale: {scale:.2f}\n"
+                f"LC: {template.name} Scale: {scale:.2f}{cached_note}\n"
                 f"Category: {template.category}\n"
                 f"Value: {template.value}\n"
                 f"Pos: ({startX}, {startY}):({endX}, {endY})\n"
                 f"Abs: ({abs_startX}, {abs_startY}):({abs_endX}, {abs_endY})\n"
+                f"Track: {template.track_hits} hits, {template.track_misses} misses\n"
             )
         
         return log_entries
+
+    def template_record(self, result, window_position, origin=(0, 0)):
+        template, startX, startY, endX, endY, scale, confidence, cached = result
+        startX, startY, endX, endY = origin[0] + startX, origin[1] + startY, origin[0] + endX, origin[1] + endY
+        return {
+            "name": template.name,
+            "category": template.category,
+            "value": template.value,
+            "confidence": float(confidence),
+            "high_confidence": bool(confidence >= self.confidence_threshold),
+            "scale": float(scale),
+            "box": [int(startX), int(startY), int(endX), int(endY)],
+            "abs_box": [int(window_position[0] + startX), int(window_position[1] + startY),
+                        int(window_position[0] + endX), int(window_position[1] + endY)],
+            "cached": bool(cached),
+            "track_hits": template.track_hits,
+            "track_misses": template.track_misses,
+        }
     
 ## GRAYSCALE 
     def detect_changes(self, img_gray):
-        if self.previous_frame is not None:
-            if self.previous_frame.shape != img_gray.shape:
-                self.previous_frame = cv2.resize(self.previous_frame, (img_gray.shape[1], img_gray.shape[0]))
-            
-            frame_diff = cv2.absdiff(self.previous_frame, img_gray)
-            change_percentage = np.mean(frame_diff) / 255 * 100
-            self.previous_frame = img_gray
-            return f"CS: {change_percentage:.2f}%"
-        
-        self.previous_frame = img_gray
-        return None
+        # Returns (change percentage, hot tile mask), the heatmap stays on change_detector.heatmap
+        with self.change_lock:
+            return self.change_detector.update(img_gray)
 
-    def match_template(self, img_gray, template):
+    def search_area(self, template, shape):
+        if template.last_match is None:
+            return 0, 0, shape[1], shape[0]
+        startX, startY, endX, endY, _ = template.last_match
+        marginX = max(TRACK_MIN_MARGIN, (endX - startX) * TRACK_MARGIN)
+        marginY = max(TRACK_MIN_MARGIN, (endY - startY) * TRACK_MARGIN)
+        return startX - marginX, startY - marginY, endX + marginX, endY + marginY
+
+    def is_unchanged(self, template, shape, change_mask):
+        if change_mask is None or template.last_result is None:
+            return False
+        rows, cols = change_mask.shape
+        startX, startY, endX, endY = self.search_area(template, shape)
+        col0, col1 = max(0, int(startX * cols / shape[1])), min(cols, int(np.ceil(endX * cols / shape[1])))
+        row0, row1 = max(0, int(startY * rows / shape[0])), min(rows, int(np.ceil(endY * rows / shape[0])))
+        return not change_mask[row0:row1, col0:col1].any()
+
+    def match_template(self, pyramid, template, name=''):
         h, w = template.shape[:2]
         found = None
-        for scale in np.linspace(0.3, 1.0, 3)[::-1]:
-            resized = cv2.resize(img_gray, (int(img_gray.shape[1] * scale), int(img_gray.shape[0] * scale)))
-            r = img_gray.shape[1] / float(resized.shape[1])
+        for index in range(len(pyramid.scales)):
+            resized, r = pyramid.level(index)
             
             if resized.shape[0] < h or resized.shape[1] < w:
                 break
             
+            start_time = time.perf_counter()
             res = cv2.matchTemplate(resized, template, cv2.TM_CCOEFF_NORMED)
             _, maxVal, _, maxLoc = cv2.minMaxLoc(res)
+            METRICS.observe('match_scale', time.perf_counter() - start_time,
+                            template=name, scale=f"{pyramid.scales[index]:.2f}", search='full')
             
             if found is None or maxVal > found[0]:
                 found = (maxVal, maxLoc, r)
@@ -162,7 +583,124 @@ class ImageProcessor:
             return startX, startY, endX, endY, 1/r, maxVal
         return None
 
+    def match_instances(self, pyramid, template):
+        h, w = template.image.shape[:2]
+        best = None
+        candidates = []
+        for index in range(len(pyramid.scales)):
+            resized, r = pyramid.level(index)
 
-    
+            if resized.shape[0] < h or resized.shape[1] < w:
+                break
+
+            start_time = time.perf_counter()
+            res = cv2.matchTemplate(resized, template.image, cv2.TM_CCOEFF_NORMED)
+            _, maxVal, _, maxLoc = cv2.minMaxLoc(res)
+            if best is None or maxVal > best[5]:
+                best = (int(maxLoc[0] * r), int(maxLoc[1] * r), int((maxLoc[0] + w) * r), int((maxLoc[1] + h) * r), 1/r, maxVal)
+            if maxVal >= self.confidence_threshold:
+                xs, ys, scores = self.find_peaks(res, h, w, template.max_instances * PEAK_OVERSAMPLE)
+                candidates.extend(zip(xs * r, ys * r, (xs + w) * r, (ys + h) * r, [1/r] * len(xs), scores))
+            METRICS.observe('match_scale', time.perf_counter() - start_time,
+                            template=template.name, scale=f"{pyramid.scales[index]:.2f}", search='instances')
+
+        if not candidates:
+            # Nothing above the threshold, report the best one as a low confidence match
+            return [best] if best else []
+
+        candidates = np.array(candidates)
+        keep = non_max_suppression(candidates[:, :4], candidates[:, 5], NMS_OVERLAP, template.max_instances)
+        return [
+            (int(startX), int(startY), int(endX), int(endY), float(scale), float(confidence))
+            for startX, startY, endX, endY, scale, confidence in candidates[keep]
+        ]
+
+    def find_peaks(self, res, h, w, limit):
+        # Local maxima over half a template, one peak per object and scale, all in one pass
+        kernel = np.ones((max(3, h // 2 | 1), max(3, w // 2 | 1)), dtype=np.uint8)
+        peaks = (res >= self.confidence_threshold) & (res >= cv2.dilate(res, kernel))
+        ys, xs = np.nonzero(peaks)
+        scores = res[ys, xs]
+        if len(scores) > limit:
+            top = np.argpartition(scores, -limit)[-limit:]
+            ys, xs, scores = ys[top], xs[top], scores[top]
+        return xs, ys, scores
+
+## TRACKING
+    def track_template(self, img_gray, template):
+        if template.last_match is None:
+            return None
+
+        last_scale = template.last_match[4]
+        startX, startY, endX, endY = self.search_area(template, img_gray.shape)
+
+        found = None
+        for scale in {min(1.0, last_scale * (1 + step)) for step in (0, -TRACK_SCALE_STEP, TRACK_SCALE_STEP)}:
+            match_result = self.match_in_region(img_gray, template.image, startX, startY, endX, endY, scale)
+            if match_result and (found is None or match_result[5] > found[5]):
+                found = match_result
+
+        if found and found[5] >= self.confidence_threshold:
+            template.track_hits += 1
+            template.last_match = found[:5]
+            return found
+
+        template.track_misses += 1
+        return None
+
+    def update_track(self, template, match_result):
+        if match_result and match_result[5] >= self.confidence_threshold:
+            template.last_match = match_result[:5]
+        else:
+            template.last_match = None
+
+    def match_template_coarse(self, pyramid, template):
+        coarse_template = template.coarse_image
+        if coarse_template is None or min(coarse_template.shape[:2]) < COARSE_MIN_SIZE:
+            return self.match_template(pyramid, template.image, template.name)
+
+        h, w = template.image.shape[:2]
+        ch, cw = coarse_template.shape[:2]
+        candidates = []
+        for index in range(len(pyramid.scales)):
+            coarse, r = pyramid.coarse_level(index, template.coarse_factor)
+
+            if coarse.shape[0] < ch or coarse.shape[1] < cw:
+                break
+
+            start_time = time.perf_counter()
+            res = cv2.matchTemplate(coarse, coarse_template, cv2.TM_CCOEFF_NORMED)
+            _, maxVal, _, maxLoc = cv2.minMaxLoc(res)
+            METRICS.observe('match_scale', time.perf_counter() - start_time,
+                            template=template.name, scale=f"{pyramid.scales[index]:.2f}", search='coarse')
+            candidates.append((maxVal, maxLoc, r, index))
+
+        # Confirm the best coarse candidates at full resolution around their location
+        found = None
+        for _, maxLoc, r, index in sorted(candidates, key=lambda c: c[0], reverse=True)[:COARSE_CANDIDATES]:
+            scale = float(pyramid.scales[index])
+            margin = 2 * r
+            startX, startY = maxLoc[0] * r - margin, maxLoc[1] * r - margin
+            endX, endY = startX + w / scale + 2 * margin, startY + h / scale + 2 * margin
+            match_result = self.match_in_region(pyramid.img_gray, template.image, startX, startY, endX, endY, scale)
+            if match_result and (found is None or match_result[5] > found[5]):
+                found = match_result
+        return found
+
+    def match_in_region(self, img_gray, template, startX, startY, endX, endY, scale):
+        h, w = template.shape[:2]
+        startX, startY = max(0, int(startX)), max(0, int(startY))
+        endX, endY = min(img_gray.shape[1], int(np.ceil(endX))), min(img_gray.shape[0], int(np.ceil(endY)))
+        region = img_gray[startY:endY, startX:endX]
+
+        width, height = int(region.shape[1] * scale), int(region.shape[0] * scale)
+        if height < h or width < w:
+            return None
 
+        resized = cv2.resize(region, (width, height))
+        res = cv2.matchTemplate(resized, template, cv2.TM_CCOEFF_NORMED)
+        _, maxVal, _, maxLoc = cv2.minMaxLoc(res)
 
+        rx, ry = region.shape[1] / float(width), region.shape[0] / float(height)
+        matchX, matchY = startX + int(maxLoc[0] * rx), startY + int(maxLoc[1] * ry)
+        return matchX, matchY, startX + int((maxLoc[0] + w) * rx), startY + int((maxLoc[1] + h) * ry), scale, maxVal
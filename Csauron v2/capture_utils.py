@@ -1,26 +1,27 @@
 ## CAPTURE_UTILS.PY
 
-import psutil
-from win32 import win32gui, win32process
-from mss import mss
-from PIL import Image
 import numpy as np
 import os
+import io
 import cv2
 from collections import deque
 import queue
 import json
+import hashlib
 import time
 import threading
-from concurrent.futures import ThreadPoolExecutor
-from dataclasses import dataclass
-from typing import List, Dict
+import gc
+from dataclasses import dataclass, replace
+from typing import List, Dict, Optional
 from contextlib import contextmanager
 
+from metrics import METRICS
+
 
 ## UTILS
 class Config:
     def __init__(self, config_file='config.json'):
+        self.config_file = config_file
         self.load_config(config_file)
 
     def load_config(self, config_file):
@@ -30,6 +31,25 @@ class Config:
         self.capture_interval = config.get('capture_interval', 4)
         self.template_dir = config.get('template_dir', '.venv/templates')
         self.confidence_threshold = config.get('confidence_threshold', 0.8)
+        self.frame_source = config.get('frame_source', {'type': 'window'})
+        self.match_backend = config.get('match_backend', 'thread')
+        self.match_workers = config.get('match_workers', None)
+        self.match_engine = config.get('match_engine', 'opencv')
+        self.log_format = config.get('log_format', 'text')
+        self.image_format = config.get('image_format', 'png')
+        self.image_quality = config.get('image_quality', None)
+        self.image_writers = config.get('image_writers', 2)
+        self.max_pending_writes = config.get('max_pending_writes', 4)
+        self.ring_capacity = config.get('ring_capacity', 10)
+        self.ring_mmap_file = config.get('ring_mmap_file', None)
+        self.template_bank = config.get('template_bank', None)
+        self.save_processed = config.get('save_processed', 'detection')
+        self.change_grid = config.get('change_grid', [32, 18])
+        self.change_threshold = config.get('change_threshold', 8)
+        self.change_noise = config.get('change_noise', 4)
+        self.metrics = config.get('metrics', {'interval': 60})
+        self.hot_reload = config.get('hot_reload', 2.0)
+        self.partial_capture = config.get('partial_capture', True)
 
 @dataclass
 class Template:
@@ -37,41 +57,167 @@ class Template:
     image: np.ndarray
     category: str
     value: int
+    search: str = 'full'
+    coarse_factor: float = 0.25
+    coarse_image: Optional[np.ndarray] = None
+    # Above 1, every non-overlapping match above the threshold is reported, up to this many
+    max_instances: int = 1
+    # (x0, y0, x1, y1) as fractions of the window, only this part is searched. None searches everything
+    region: Optional[tuple] = None
+    # Mean and norm of the zero-mean image, as used by TM_CCOEFF_NORMED
+    mean: float = 0.0
+    norm: float = 0.0
+    # Last confident (startX, startY, endX, endY, scale), searched first on the next frame
+    last_match: Optional[tuple] = None
+    track_hits: int = 0
+    track_misses: int = 0
+    # Last (startX, startY, endX, endY, scale, confidence), carried forward when its area did not change.
+    # A list of them for multi-instance templates
+    last_result: Optional[tuple] = None
     
 # LOAD TEMPLATES AND METADATA
+TEMPLATE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
 class TemplateManager:
-    def __init__(self, template_dir: str, metadata_file: str = 'templates_metadata.json'):
+    def __init__(self, template_dir: str, metadata_file: str = 'templates_metadata.json', bank_file: Optional[str] = None):
         self.template_dir = template_dir
         self.metadata_file = metadata_file
+        self.bank_file = bank_file
+        # Bumped on every reload that changed something
+        self.generation = 0
         self.templates: List[Template] = self.load_templates()
 
     def load_templates(self) -> List[Template]:
         if not os.path.exists(self.template_dir):
             raise ValueError(f"Template directory not found: {self.template_dir}")
-        
-        metadata = self.load_metadata()
-        templates = []
 
-        for filename in os.listdir(self.template_dir):
-            if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-                template_path = os.path.join(self.template_dir, filename)
-                template_image = cv2.imread(template_path, 0)
-                if template_image is not None:
-                    template_info = metadata.get(filename, {})
-                    templates.append(Template(
-                        name=filename,
-                        image=template_image,
-                        category=template_info.get('category', 'uncategorized'),
-                        value=template_info.get('value', 0),
-                    ))
-                else:
-                    print(f"Warning: Could not load template {filename}")
+        # Taken before reading, a file written meanwhile is picked up by the next reload
+        self.file_fingerprints = self.scan_files()
+        self.metadata_fingerprint = TemplateBank.fingerprint(self.metadata_file)
+        self.metadata = self.load_metadata()
+
+        if self.bank_file:
+            templates = TemplateBank.load(self.bank_file, self.template_dir, self.metadata_file)
+            if templates is not None:
+                return templates
+            print(f"Template bank {self.bank_file} is missing or out of date, compiling it.")
+            templates = self.load_template_files()
+            TemplateBank.write(self.bank_file, templates, self.template_dir, self.metadata_file)
+            return templates
+        return self.load_template_files()
+
+    def load_template_files(self) -> List[Template]:
+        templates = []
+        for filename in TemplateBank.source_files(self.template_dir):
+            template = self.load_template_file(filename, self.metadata.get(filename, {}))
+            if template is not None:
+                templates.append(template)
         
         if not templates:
             raise ValueError("No valid template images found in the templates directory.")
         
         return templates
 
+    def load_template_file(self, filename: str, template_info: Dict) -> Optional[Template]:
+        template_image = cv2.imread(os.path.join(self.template_dir, filename), 0)
+        if template_image is None:
+            print(f"Warning: Could not load template {filename}")
+            return None
+        mean, norm = self.template_stats(template_image)
+        return self.apply_metadata(Template(
+            name=filename,
+            image=template_image,
+            category='uncategorized',
+            value=0,
+            mean=mean,
+            norm=norm,
+        ), template_info)
+
+    def apply_metadata(self, template: Template, template_info: Dict) -> Template:
+        search = template_info.get('search', 'full')
+        coarse_factor = template_info.get('coarse_factor', 0.25)
+        coarse_image = None
+        if search == 'coarse':
+            coarse_image = self.build_coarse_image(template.image, coarse_factor)
+        max_instances = template_info.get('max_instances', 1)
+        region = self.parse_region(template.name, template_info.get('region'))
+        return replace(
+            template,
+            category=template_info.get('category', 'uncategorized'),
+            value=template_info.get('value', 0),
+            search=search,
+            coarse_factor=coarse_factor,
+            coarse_image=coarse_image,
+            max_instances=max_instances,
+            region=region,
+            # A cached result has the shape of the old mode, tracking only exists for single instances
+            last_result=None,
+            last_match=template.last_match if max_instances == 1 else None,
+        )
+
+    def parse_region(self, name: str, region) -> Optional[tuple]:
+        if region is None:
+            return None
+        try:
+            x0, y0, x1, y1 = (float(value) for value in region)
+        except (TypeError, ValueError):
+            x0 = x1 = 0
+        if not (0 <= x0 < x1 <= 1 and 0 <= y0 < y1 <= 1):
+            print(f"Warning: Invalid region {region} for template {name}, searching the whole window")
+            return None
+        return x0, y0, x1, y1
+
+    def scan_files(self) -> Dict:
+        return {
+            filename: TemplateBank.fingerprint(os.path.join(self.template_dir, filename))
+            for filename in TemplateBank.source_files(self.template_dir)
+        }
+
+    def reload(self):
+        # Recompiles changed or new templates only, unchanged ones keep their images, tracking
+        # state and matcher caches. Returns (recompiled, removed names) or None when nothing changed.
+        files = self.scan_files()
+        metadata_fingerprint = TemplateBank.fingerprint(self.metadata_file)
+        if files == self.file_fingerprints and metadata_fingerprint == self.metadata_fingerprint:
+            return None
+
+        metadata = self.load_metadata() if metadata_fingerprint != self.metadata_fingerprint else self.metadata
+        current = {template.name: template for template in self.templates}
+        templates = []
+        recompiled = 0
+        for filename in files:
+            template = current.get(filename)
+            template_info = metadata.get(filename, {})
+            if template is None or files[filename] != self.file_fingerprints.get(filename):
+                template = self.load_template_file(filename, template_info)
+                if template is None:
+                    continue
+                recompiled += 1
+            elif template_info != self.metadata.get(filename, {}):
+                template = self.apply_metadata(template, template_info)
+                recompiled += 1
+            templates.append(template)
+        removed = [name for name in current if name not in {template.name for template in templates}]
+
+        self.file_fingerprints = files
+        self.metadata_fingerprint = metadata_fingerprint
+        self.metadata = metadata
+        # Single assignment, a frame in progress keeps the list it started with.
+        # The bank stays as it is, it is memory-mapped now and is rebuilt on the next start.
+        self.templates = templates
+        self.generation += 1
+        return recompiled, removed
+
+    def template_stats(self, template_image: np.ndarray):
+        pixels = template_image.astype(np.float64)
+        mean = float(pixels.mean())
+        return mean, float(np.sqrt(((pixels - mean) ** 2).sum()))
+
+    def build_coarse_image(self, template_image: np.ndarray, coarse_factor: float) -> np.ndarray:
+        h, w = template_image.shape[:2]
+        size = (max(1, int(w * coarse_factor)), max(1, int(h * coarse_factor)))
+        return cv2.resize(template_image, size, interpolation=cv2.INTER_AREA)
+
     def load_metadata(self) -> Dict:
         try:
             with open(self.metadata_file, 'r') as f:
@@ -84,128 +230,562 @@ class TemplateManager:
             return {}
 
 ## GET WINDOW
+# OS calls used by WindowManager. Any object with the same methods (e.g. a fake window table) can replace it.
+class Win32WindowBackend:
+    def __init__(self):
+        # Imported here, replay and synthetic sources run anywhere and never load pywin32 or psutil
+        try:
+            from win32 import win32gui, win32process
+        except ImportError:
+            raise RuntimeError("pywin32 is required to capture a live window. Use a replay or synthetic frame_source instead.") from None
+        import psutil
+        self.win32gui = win32gui
+        self.win32process = win32process
+        self.psutil = psutil
+
+    def enum_windows(self):
+        hwnds = []
+        self.win32gui.EnumWindows(lambda hwnd, found: found.append(hwnd) or True, hwnds)
+        return hwnds
+
+    def is_window(self, hwnd):
+        return bool(self.win32gui.IsWindow(hwnd))
+
+    def is_visible(self, hwnd):
+        return bool(self.win32gui.IsWindowVisible(hwnd))
+
+    def get_window_text(self, hwnd):
+        return self.win32gui.GetWindowText(hwnd)
+
+    def get_window_pid(self, hwnd):
+        _, pid = self.win32process.GetWindowThreadProcessId(hwnd)
+        return pid
+
+    def get_window_rect(self, hwnd):
+        return tuple(self.win32gui.GetWindowRect(hwnd))
+
+    def get_process_name(self, pid):
+        try:
+            return self.psutil.Process(pid).name()
+        except self.psutil.NoSuchProcess:
+            return None
+
+
+# Window table in memory, WindowManager runs without pywin32 on it.
+# windows: {hwnd: {"title": str, "pid": int, "rect": (left, top, right, bottom), "visible": bool}},
+# processes: {pid: process name}. Edit both between calls to move, close or replace windows.
+class FakeWindowBackend:
+    def __init__(self, windows=None, processes=None):
+        self.windows = windows if windows is not None else {}
+        self.processes = processes if processes is not None else {}
+
+    def enum_windows(self):
+        return list(self.windows)
+
+    def is_window(self, hwnd):
+        return hwnd in self.windows
+
+    def is_visible(self, hwnd):
+        return self.windows[hwnd].get('visible', True)
+
+    def get_window_text(self, hwnd):
+        return self.windows[hwnd].get('title', '')
+
+    def get_window_pid(self, hwnd):
+        return self.windows[hwnd]['pid']
+
+    def get_window_rect(self, hwnd):
+        return tuple(self.windows[hwnd]['rect'])
+
+    def get_process_name(self, pid):
+        return self.processes.get(pid)
+
+
 class WindowManager:
-    def __init__(self, target_window):
+    def __init__(self, target_window, backend=None):
         self.target_window = target_window
+        self.backend = backend if backend is not None else Win32WindowBackend()
+        # Resolved window, re-checked cheaply every frame
+        self.hwnd = None
+        self.pid = None
+        self.window_rect = None
+        self.enumerations = 0
 
     def get_target_window(self):
-        def enum_windows_callback(hwnd, target_windows):
-            if win32gui.IsWindowVisible(hwnd) and win32gui.GetWindowText(hwnd):
-                _, pid = win32process.GetWindowThreadProcessId(hwnd)
-                try:
-                    process = psutil.Process(pid)
-                    if process.name().lower() == self.target_window.lower():
-                        target_windows.append(hwnd)
-                except psutil.NoSuchProcess:
-                    pass
-            return True
-
-        target_windows = []
-        win32gui.EnumWindows(enum_windows_callback, target_windows)
-        
-        return target_windows[0] if target_windows else None
+        if self.hwnd is not None and self.is_cached_window_valid():
+            return self.hwnd
+
+        self.hwnd, self.pid, self.window_rect = None, None, None
+        hwnd = self.find_target_window()
+        if hwnd is not None:
+            self.hwnd = hwnd
+            self.pid = self.backend.get_window_pid(hwnd)
+            self.window_rect = self.backend.get_window_rect(hwnd)
+        return self.hwnd
+
+    def is_cached_window_valid(self):
+        try:
+            return (self.backend.is_window(self.hwnd)
+                    and self.backend.get_window_pid(self.hwnd) == self.pid
+                    and self.backend.get_window_rect(self.hwnd) == self.window_rect)
+        except Exception:
+            return False
+
+    def find_target_window(self):
+        self.enumerations += 1
+        for hwnd in self.backend.enum_windows():
+            if self.backend.is_visible(hwnd) and self.backend.get_window_text(hwnd):
+                process_name = self.backend.get_process_name(self.backend.get_window_pid(hwnd))
+                if process_name and process_name.lower() == self.target_window.lower():
+                    return hwnd
+        return None
 
 # INITIAL SCREENSHOT
 class ScreenshotManager:
-    def __init__(self, max_screenshots=5):
-        self.max_screenshots = max_screenshots
-        self.screenshot_queue = deque(maxlen=max_screenshots)
-        os.makedirs('screenshots', exist_ok=True)
-        self.executor = ThreadPoolExecutor(max_workers=8)
+    def __init__(self):
         self.thread_local = threading.local()
-        self.deletion_queue = queue.Queue()
-        self.cleanup_thread = threading.Thread(target=self.cleanup_old_screenshots, daemon=True)
-        self.cleanup_thread.start()
 
     @contextmanager
     def get_mss(self):
         if not hasattr(self.thread_local, 'sct'):
+            from mss import mss
             self.thread_local.sct = mss()
         yield self.thread_local.sct
 
-    def capture_window(self, hwnd):
-        left, top, right, bottom = win32gui.GetWindowRect(hwnd)
+    def capture_window(self, hwnd, window_rect=None, box=None):
+        # box is (x0, y0, x1, y1) in window pixels, only that part of the window is grabbed
+        if window_rect is None:
+            from win32 import win32gui
+            window_rect = win32gui.GetWindowRect(hwnd)
+        left, top, right, bottom = window_rect
         width, height = right - left, bottom - top
+        x0, y0, x1, y1 = box if box is not None else (0, 0, width, height)
 
-        monitor = {"top": top, "left": left, "width": width, "height": height}
+        monitor = {"top": top + y0, "left": left + x0, "width": x1 - x0, "height": y1 - y0}
         
         with self.get_mss() as sct:
             screenshot = sct.grab(monitor)
-            img = Image.frombytes("RGB", screenshot.size, screenshot.rgb)
-        
-        timestamp = int(time.time())
-        screenshot_path = os.path.join('screenshots', f'screenshot_{timestamp}.png')
-        
-        # Save the screenshot asynchronously
-        self.executor.submit(self.save_screenshot, img, screenshot_path)
-        
-        self.manage_screenshot_queue(timestamp)
+        # BGRA view straight over the mss buffer, no PIL image and no copy
+        img = np.frombuffer(screenshot.raw, dtype=np.uint8).reshape(screenshot.height, screenshot.width, 4)
         
         return img, (left, top)
 
-    def save_screenshot(self, img, path):
-        with open(path, 'wb') as f:
-            img.save(f, format='PNG', optimize=True)
 
-    def manage_screenshot_queue(self, timestamp):
-        self.screenshot_queue.append(timestamp)
-        if len(self.screenshot_queue) == self.max_screenshots:
-            old_timestamp = self.screenshot_queue[0]
-            old_file = os.path.join('screenshots', f'screenshot_{old_timestamp}.png')
-            self.deletion_queue.put(old_file)
+## COMPILED TEMPLATE BANK
+# One flat uint8 .npy, memory-mapped on start: an 8 byte index length, the JSON index
+# (shapes, offsets, stats, metadata) and then every template image and coarse variant.
+# The index records mtime, size and sha1 of every source file. Mtime and size are checked
+# first, the hash only when they differ, so an unchanged bank is validated without reading images.
+BANK_VERSION = 3
 
-    def cleanup_old_screenshots(self):
-        while True:
-            try:
-                file_to_delete = self.deletion_queue.get(timeout=1)
-                self.delete_file_with_retry(file_to_delete)
-            except queue.Empty:
-                continue
+class TemplateBank:
+    @staticmethod
+    def source_files(template_dir):
+        return sorted(filename for filename in os.listdir(template_dir) if filename.lower().endswith(TEMPLATE_EXTENSIONS))
 
-    def delete_file_with_retry(self, file_path, max_attempts=5, delay=1):
-        for attempt in range(max_attempts):
-            try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                break
-            except PermissionError:
-                if attempt < max_attempts - 1:
-                    time.sleep(delay)
-                else:
-                    print(f"Failed to delete {file_path} after {max_attempts} attempts")
-
-    def __del__(self):
-        self.executor.shutdown(wait=True)
-        # Wait for the cleanup thread to finish
-        self.deletion_queue.put(None)  # Signal to stop the cleanup thread
-        self.cleanup_thread.join(timeout=5)
+    @staticmethod
+    def fingerprint(path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "sha1": None}
+
+    @staticmethod
+    def file_hash(path):
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    @staticmethod
+    def is_unchanged(path, entry):
+        current = TemplateBank.fingerprint(path)
+        if current is None or entry is None:
+            return current is None and entry is None
+        if current["size"] != entry["size"]:
+            return False
+        return current["mtime_ns"] == entry["mtime_ns"] or TemplateBank.file_hash(path) == entry["sha1"]
+
+    @staticmethod
+    def sources(template_dir, metadata_file):
+        files = {}
+        for filename in TemplateBank.source_files(template_dir):
+            path = os.path.join(template_dir, filename)
+            files[filename] = TemplateBank.fingerprint(path)
+            files[filename]["sha1"] = TemplateBank.file_hash(path)
+        metadata = TemplateBank.fingerprint(metadata_file)
+        if metadata is not None:
+            metadata["sha1"] = TemplateBank.file_hash(metadata_file)
+        return files, metadata
+
+    @staticmethod
+    def is_current(index, template_dir, metadata_file):
+        if index.get("version") != BANK_VERSION:
+            return False
+        if TemplateBank.source_files(template_dir) != sorted(index["files"]):
+            return False
+        if not TemplateBank.is_unchanged(metadata_file, index["metadata"]):
+            return False
+        return all(TemplateBank.is_unchanged(os.path.join(template_dir, filename), entry) for filename, entry in index["files"].items())
+
+    @staticmethod
+    def write(bank_file, templates, template_dir, metadata_file):
+        # A source changing after it was read only costs a recompile on the next start
+        files, metadata = TemplateBank.sources(template_dir, metadata_file)
+        entries = []
+        offset = 0
+        for template in templates:
+            entry = {
+                "name": template.name,
+                "category": template.category,
+                "value": template.value,
+                "search": template.search,
+                "coarse_factor": template.coarse_factor,
+                "max_instances": template.max_instances,
+                "region": template.region,
+                "mean": template.mean,
+                "norm": template.norm,
+                "image": None,
+                "coarse_image": None,
+            }
+            for key in ("image", "coarse_image"):
+                img = getattr(template, key)
+                if img is not None:
+                    entry[key] = [offset, img.shape[0], img.shape[1]]
+                    offset += img.size
+            entries.append(entry)
+
+        index = json.dumps({"version": BANK_VERSION, "files": files, "metadata": metadata, "templates": entries}).encode()
+        data_start = 8 + len(index)
+        temp_path = f"{bank_file}.{os.getpid()}.tmp"
+        blob = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.uint8, shape=(data_start + offset,))
+        blob[:8] = np.frombuffer(np.uint64(len(index)).tobytes(), dtype=np.uint8)
+        blob[8:data_start] = np.frombuffer(index, dtype=np.uint8)
+        for template, entry in zip(templates, entries):
+            for key in ("image", "coarse_image"):
+                if entry[key] is not None:
+                    start = data_start + entry[key][0]
+                    img = getattr(template, key)
+                    blob[start:start + img.size] = img.ravel()
+        blob.flush()
+        del blob
+        # Single file, readers see either the old bank or the new one
+        os.replace(temp_path, bank_file)
+
+    @staticmethod
+    def load(bank_file, template_dir, metadata_file):
+        try:
+            blob = np.load(bank_file, mmap_mode='r')
+            index_size = int(blob[:8].view(np.uint64)[0])
+            index = json.loads(blob[8:8 + index_size].tobytes())
+            if not TemplateBank.is_current(index, template_dir, metadata_file):
+                return None
+        except (FileNotFoundError, ValueError, KeyError, TypeError, IndexError):
+            return None
+
+        data = blob[8 + index_size:]
+        def view(entry):
+            if entry is None:
+                return None
+            offset, height, width = entry
+            return data[offset:offset + height * width].reshape(height, width)
+
+        return [
+            Template(
+                name=entry["name"],
+                image=view(entry["image"]),
+                category=entry["category"],
+                value=entry["value"],
+                search=entry["search"],
+                coarse_factor=entry["coarse_factor"],
+                coarse_image=view(entry["coarse_image"]),
+                max_instances=entry["max_instances"],
+                region=tuple(entry["region"]) if entry["region"] is not None else None,
+                mean=entry["mean"],
+                norm=entry["norm"],
+            )
+            for entry in index["templates"]
+        ]
+
+
+## FRAME RING BUFFER
+# Keeps the last N raw frames in memory instead of writing every capture to disk.
+# Slots are allocated once at the largest frame size seen. With mmap_file the frames and a
+# metadata table are .npy files that another process can np.load(..., mmap_mode='r'),
+# and that are still on disk after a crash.
+RING_META_COLUMNS = ('sequence', 'timestamp', 'height', 'width', 'channels', 'left', 'top')
+
+class FrameRingBuffer:
+    def __init__(self, capacity=10, mmap_file=None):
+        self.capacity = capacity
+        self.mmap_file = mmap_file
+        self.frames = None
+        self.meta = None
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def allocate(self, shape):
+        frames_shape = (self.capacity,) + shape
+        meta_shape = (self.capacity, len(RING_META_COLUMNS))
+        if self.mmap_file and self.frames is not None:
+            # Windows cannot truncate a file that is still mapped, the old maps are closed first
+            self.flush()
+            self.frames = self.meta = None
+            gc.collect()
+        if self.mmap_file:
+            self.frames = np.lib.format.open_memmap(self.mmap_file, mode='w+', dtype=np.uint8, shape=frames_shape)
+            self.meta = np.lib.format.open_memmap(self.mmap_file + '.meta.npy', mode='w+', dtype=np.float64, shape=meta_shape)
+        else:
+            self.frames = np.empty(frames_shape, dtype=np.uint8)
+            self.meta = np.zeros(meta_shape, dtype=np.float64)
+        self.meta[:, 0] = -1
+
+    def push(self, img, window_position, timestamp):
+        img = img if img.ndim == 3 else img[:, :, None]
+        height, width, channels = img.shape
+        with self.lock:
+            if self.frames is None or any(size > limit for size, limit in zip(img.shape, self.frames.shape[1:])):
+                # Grow to the new largest size, older frames are dropped
+                shape = img.shape if self.frames is None else tuple(map(max, img.shape, self.frames.shape[1:]))
+                self.allocate(shape)
+            slot = self.sequence % self.capacity
+            self.frames[slot, :height, :width, :channels] = img
+            self.meta[slot] = (self.sequence, timestamp, height, width, channels, window_position[0], window_position[1])
+            self.sequence += 1
+
+    def latest(self, count=None):
+        # Copies of the newest frames first, as (img, window_position, timestamp)
+        with self.lock:
+            if self.frames is None:
+                return []
+            stored = min(self.sequence, self.capacity)
+            count = stored if count is None else min(count, stored)
+            frames = []
+            for sequence in range(self.sequence - 1, self.sequence - 1 - count, -1):
+                slot = sequence % self.capacity
+                stored_sequence, timestamp, height, width, channels, left, top = self.meta[slot]
+                if int(stored_sequence) != sequence:
+                    # Slot was cleared when the buffer grew
+                    break
+                img = self.frames[slot, :int(height), :int(width), :int(channels)].copy()
+                frames.append((img, (int(left), int(top)), float(timestamp)))
+            return frames
+
+    def dump(self, image_writer, directory='screenshots', count=None):
+        # Encode buffered frames to disk, only when asked (detection, key press)
+        os.makedirs(directory, exist_ok=True)
+        frames = self.latest(count)
+        for img, _, timestamp in frames:
+            path = os.path.join(directory, f'screenshot_{timestamp}{image_writer.extension}')
+            image_writer.submit('screenshot', path, img, copy=False)
+        return len(frames)
+
+    def flush(self):
+        if self.mmap_file and self.frames is not None:
+            self.frames.flush()
+            self.meta.flush()
 
 
 ## LOGGER 
+# Capture threads only format and enqueue. One background thread owns the file and writes
+# batches when batch_size records are waiting or flush_interval seconds have passed.
+# log_format 'jsonl' writes one JSON record per frame instead of the free text entries.
 class Logger:
-    def __init__(self, log_file):
+    def __init__(self, log_file, log_format='text', batch_size=64, flush_interval=1.0, max_pending=10000):
         self.log_file = log_file
+        self.log_format = log_format
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.dropped = 0
+        self.writer_thread = threading.Thread(target=self.write_batches, daemon=True)
+        self.writer_thread.start()
+
+    def log_frame(self, timestamp, log_entries, record):
+        if self.log_format == 'jsonl':
+            self.write_record(record)
+        else:
+            self.write_log(timestamp, log_entries)
 
     def write_log(self, timestamp, log_entries):
         log_content = f"Timestamp: {timestamp}\n" + "\n".join(log_entries) + "\n" + "-" * 50 + "\n"
+        self.enqueue(log_content)
+
+    def write_record(self, record):
+        self.enqueue(json.dumps(record, separators=(',', ':')) + "\n")
+
+    def enqueue(self, line):
+        try:
+            self.pending.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def write_batches(self):
         with open(self.log_file, 'a') as f:
-            f.write(log_content)
-            print(f"{timestamp} Log written.")
+            running = True
+            while running:
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    try:
+                        line = self.pending.get(timeout=max(0.0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    if line is None:
+                        running = False
+                        break
+                    batch.append(line)
+                if batch:
+                    with METRICS.timer('log_write'):
+                        f.write("".join(batch))
+                        f.flush()
+
+    def close(self):
+        self.pending.put(None)
+        self.writer_thread.join(timeout=5)
+        if self.dropped:
+            print(f"Logger dropped {self.dropped} entries because the writer could not keep up.")
+
+
+## IMAGE PERSISTENCE
+# Bounded pool of writer threads. When more than max_pending writes are waiting, the oldest
+# pending write is dropped, so under load only the newest images reach the disk.
+# quality is the PNG compression level (0-9) or the JPEG/WebP quality (0-100).
+ENCODERS = {
+    'png': ('.png', cv2.IMWRITE_PNG_COMPRESSION, 1),
+    'jpeg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY, 90),
+    'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY, 90),
+    'npy': ('.npy', None, None),
+}
+
+class ImageWriterPool:
+    def __init__(self, image_format='png', quality=None, workers=2, max_pending=4):
+        if image_format not in ENCODERS:
+            raise ValueError(f"Unknown image format: {image_format}. Use one of {list(ENCODERS)}")
+        self.image_format = image_format
+        self.extension, self.quality_flag, default_quality = ENCODERS[image_format]
+        self.quality = default_quality if quality is None else quality
+        self.max_pending = max_pending
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.running = True
+        self.dropped = 0
+        self.written = 0
+        # format -> [count, total seconds, max seconds]
+        self.encode_times = {}
+        self.workers = [threading.Thread(target=self.write_loop, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, kind, path, img, copy=True, on_written=None, annotations=None):
+        # Frames from ImageProcessor live in reused buffers, so they are copied by default.
+        # annotations are drawn by the writer thread, see draw_annotations
+        job = (kind, path, img.copy() if copy else img, on_written, annotations)
+        with self.condition:
+            if len(self.pending) >= self.max_pending:
+                self.pending.popleft()
+                self.dropped += 1
+            self.pending.append(job)
+            self.condition.notify()
+
+    def encode(self, img):
+        if self.image_format == 'npy':
+            buffer = io.BytesIO()
+            np.save(buffer, img)
+            return buffer.getvalue()
+        if img.ndim == 3 and img.shape[2] == 4:
+            # The 4th byte of an mss capture is undefined (0 on GDI), written as alpha it makes the image transparent
+            img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+        ok, encoded = cv2.imencode(self.extension, img, [self.quality_flag, int(self.quality)])
+        if not ok:
+            raise ValueError(f"Could not encode image as {self.image_format}")
+        return encoded.tobytes()
+
+    def write_loop(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                kind, path, img, on_written, annotations = self.pending.popleft()
+
+            try:
+                if annotations is not None:
+                    with METRICS.timer('annotate'):
+                        img = draw_annotations(img, annotations)
+                start_time = time.perf_counter()
+                data = self.encode(img)
+                encode_time = time.perf_counter() - start_time
+                self.record_encode_time(encode_time)
+                METRICS.observe('encode', encode_time, format=self.image_format)
+                with METRICS.timer('write', kind=kind):
+                    with open(path, 'wb') as f:
+                        f.write(data)
+                self.written += 1
+                if on_written:
+                    on_written(path)
+            except Exception as e:
+                print(f"Failed to write {kind} image {path}: {e}")
+
+    def record_encode_time(self, seconds):
+        with self.condition:
+            timing = self.encode_times.setdefault(self.image_format, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    def stats(self):
+        with self.condition:
+            return {
+                "queue_depth": len(self.pending),
+                "dropped": self.dropped,
+                "written": self.written,
+                "encode_ms": {
+                    image_format: {"count": count, "mean": total / count * 1000, "max": longest * 1000}
+                    for image_format, (count, total, longest) in self.encode_times.items()
+                },
+            }
+
+    def close(self):
+        # Pending writes are finished before the workers exit
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join(timeout=10)
+
+
+# ANNOTATIONS
+# Recorded per frame as (cv2 drawing function, *arguments), e.g. ('rectangle', (x0, y0), (x1, y1), (0, 255, 0), 1).
+# Only drawn when a frame is saved or shown, on a BGR version of it.
+def draw_annotations(img, annotations):
+    # Draws in place on BGR frames, BGRA and gray frames are converted to a new BGR image first
+    if img.ndim == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    elif img.shape[2] == 4:
+        img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+    for function, *args in annotations:
+        getattr(cv2, function)(img, *args)
+    return img
 
 
 # SAVE IMAGES FOR DEBUG (CAN REMOVE BUT GOOD DEBUG)
 class ImageSaver:
-    def __init__(self, max_saved_images=5):
+    def __init__(self, max_saved_images=5, image_writer=None):
         self.max_saved_images = max_saved_images
         self.processed_queue = deque(maxlen=max_saved_images)
-
-    def save_processed_image(self, timestamp, img_cv):
+        self.image_writer = image_writer if image_writer is not None else ImageWriterPool()
+        self.queue_lock = threading.Lock()
         os.makedirs('processed', exist_ok=True)
-        cv2.imwrite(f'processed/processed_{timestamp}.png', img_cv)
-        
-        self.processed_queue.append(timestamp)
-        if len(self.processed_queue) == self.max_saved_images:
-            old_timestamp = self.processed_queue[0]
-            old_file = f'processed/processed_{old_timestamp}.png'
-            if os.path.exists(old_file):
-                os.remove(old_file)
+
+    def save_processed_image(self, timestamp, img, annotations=None):
+        path = f'processed/processed_{timestamp}{self.image_writer.extension}'
+        self.image_writer.submit('processed', path, img, on_written=self.rotate_processed_images, annotations=annotations)
+
+    def rotate_processed_images(self, path):
+        with self.queue_lock:
+            self.processed_queue.append(path)
+            if len(self.processed_queue) == self.max_saved_images:
+                old_file = self.processed_queue[0]
+                if os.path.exists(old_file):
+                    os.remove(old_file)
@@ -0,0 +1,42 @@
+# COMPILE_TEMPLATES.PY
+# Builds the template bank ahead of time, so the first capture start does not pay for it.
+#   python compile_templates.py --template-dir .venv/templates --output templates_bank.npy
+# Set "template_bank": "templates_bank.npy" in config.json to load it. An out of date bank is
+# rebuilt on start anyway, this script only moves the cost.
+
+import argparse
+import os
+import time
+
+from capture_utils import Config, TemplateManager, TemplateBank
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile the template images and metadata into one memory-mappable bank file.")
+    parser.add_argument('--config', default='config.json', help="Read template_dir and template_bank from this config when present")
+    parser.add_argument('--template-dir')
+    parser.add_argument('--metadata', default='templates_metadata.json')
+    parser.add_argument('--output')
+    parser.add_argument('--force', action='store_true', help="Rebuild even when the bank is up to date")
+    args = parser.parse_args()
+
+    config = Config(args.config) if os.path.exists(args.config) else None
+    template_dir = args.template_dir or (config.template_dir if config else '.venv/templates')
+    bank_file = args.output or (config.template_bank if config else None) or 'templates_bank.npy'
+
+    start_time = time.perf_counter()
+    if not args.force and TemplateBank.load(bank_file, template_dir, args.metadata) is not None:
+        print(f"{bank_file} is up to date.")
+        return
+    templates = TemplateManager(template_dir, args.metadata).templates
+    TemplateBank.write(bank_file, templates, template_dir, args.metadata)
+    print(f"Compiled {len(templates)} templates into {bank_file} "
+          f"({os.path.getsize(bank_file) / 1024:.0f} KB) in {time.perf_counter() - start_time:.2f}s")
+
+    start_time = time.perf_counter()
+    TemplateManager(template_dir, args.metadata, bank_file)
+    print(f"Loading it takes {(time.perf_counter() - start_time) * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
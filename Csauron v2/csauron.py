@@ -1,15 +1,19 @@
 # CSAURON.PY RUNNER
 
+import os
 import time
-from concurrent.futures import ThreadPoolExecutor
 import threading
-import queue
-import keyboard
 import traceback
-import numpy as np
 
-from capture_utils import Config, TemplateManager, WindowManager, ScreenshotManager, Logger, ImageSaver
+from capture_utils import Config, TemplateManager, WindowManager, ScreenshotManager, Logger, ImageSaver, ImageWriterPool, FrameRingBuffer
 from capture_processor import ImageProcessor
+from frame_sources import WindowFrameSource, ReplayFrameSource, SyntheticFrameSource
+from scheduler import LatestFrameScheduler
+from metrics import METRICS, MetricsReporter
+
+
+# Config keys applied while running, the others need a restart
+HOT_CONFIG_KEYS = ('confidence_threshold', 'capture_interval', 'save_processed')
 
 
 class WindowCapture:
@@ -19,99 +23,307 @@ class WindowCapture:
         self.setup_execution_environment()
 
     def initialize_components(self):
-        self.template_manager = TemplateManager(self.config.template_dir)
-        self.window_manager = WindowManager(self.config.target_window)
-        self.screenshot_manager = ScreenshotManager()
-        self.image_processor = ImageProcessor(self.config.confidence_threshold)
-        self.logger = Logger('match_log.txt')
-        self.image_saver = ImageSaver()
+        self.template_manager = TemplateManager(self.config.template_dir, bank_file=self.config.template_bank)
+        self.image_writer = ImageWriterPool(
+            self.config.image_format,
+            quality=self.config.image_quality,
+            workers=self.config.image_writers,
+            max_pending=self.config.max_pending_writes,
+        )
+        self.frame_ring = FrameRingBuffer(self.config.ring_capacity, mmap_file=self.config.ring_mmap_file)
+        self.frame_source = self.create_frame_source(self.config.frame_source)
+        self.image_processor = ImageProcessor(
+            self.config.confidence_threshold,
+            tile_grid=self.config.change_grid,
+            tile_threshold=self.config.change_threshold,
+            match_engine=self.config.match_engine,
+            noise_threshold=self.config.change_noise,
+        )
+        if self.config.match_backend == 'process':
+            # multiprocessing is only loaded for this backend
+            from match_pool import ProcessMatchPool
+            self.image_processor.match_pool = ProcessMatchPool(
+                self.config.template_dir,
+                self.config.confidence_threshold,
+                self.image_processor.scales,
+                workers=self.config.match_workers,
+                bank_file=self.config.template_bank,
+                match_engine=self.config.match_engine,
+            )
+        if self.config.partial_capture:
+            # Only the union of template regions and pixel probes is grabbed, when every template has a region
+            self.frame_source.capture_box = self.capture_box
+        log_file = 'match_log.jsonl' if self.config.log_format == 'jsonl' else 'match_log.txt'
+        self.logger = Logger(log_file, log_format=self.config.log_format)
+        self.image_saver = ImageSaver(image_writer=self.image_writer)
+        self.metrics_reporter = MetricsReporter(
+            METRICS,
+            interval=self.config.metrics.get('interval', 60),
+            prometheus_file=self.config.metrics.get('prometheus_file'),
+            port=self.config.metrics.get('port'),
+        )
 
+    def create_frame_source(self, source):
+        source_type = source.get('type', 'window')
+        if source_type == 'window':
+            self.window_manager = WindowManager(self.config.target_window)
+            self.screenshot_manager = ScreenshotManager()
+            return WindowFrameSource(self.window_manager, self.screenshot_manager)
+        if source_type == 'replay':
+            return ReplayFrameSource(source['path'], loop=source.get('loop', False))
+        if source_type == 'synthetic':
+            return SyntheticFrameSource(
+                self.template_manager.templates,
+                width=source.get('width', 1280),
+                height=source.get('height', 720),
+                frames=source.get('frames', 100),
+                scales=source.get('scales', (1.0, 0.65)),
+                jitter=source.get('jitter', 0),
+                seed=source.get('seed', 0),
+            )
+        raise ValueError(f"Unknown frame source type: {source_type}")
+
+    def capture_box(self, width, height):
+        return self.image_processor.capture_box((width, height), self.template_manager.templates)
 
     def setup_execution_environment(self):
-        self.processing_queue = queue.Queue(maxsize=5)
+        self.scheduler = LatestFrameScheduler(self.config.capture_interval)
         self.running = False
         self.paused = False
-        self.last_capture_time = 0
-        self.executor = ThreadPoolExecutor(max_workers=8)
+        # Wakes the capture thread early on stop and pause/resume
+        self.wake_event = threading.Event()
+        self.reload_event = threading.Event()
+        # Template names that were high confidence on the previous frame
+        self.previous_detections = set()
+        self.config_mtime = os.stat(self.config.config_file).st_mtime_ns
         self.stop_key = 'l'
         self.pause_key = 'p'
+        self.save_key = 's'
 
     def handle_exception(self, error_message):
         print(f"Error: {error_message}")
         print(traceback.format_exc())
 
-    def capture_and_process_loop(self):
+    def capture_loop(self):
         while self.running:
-            if not self.paused:
-                try:
-                    current_time = time.time()
-                    if current_time - self.last_capture_time >= self.config.capture_interval:
-                        self.capture_and_enqueue()
-                        self.last_capture_time = current_time
-                    
-                    try:
-                        img, window_position = self.processing_queue.get(timeout=0.01)
-                        self.executor.submit(self.process_image, img, window_position)
-                    except queue.Empty:
-                        pass
-                except Exception:
-                    print("Error in capture and process loop:")
-                    print(traceback.format_exc())
-            else:
-                time.sleep(0.01)  # Sleep briefly when paused to reduce CPU usage
+            if self.paused:
+                self.wake_event.wait()
+                self.wake_event.clear()
+                continue
+            start_time = time.perf_counter()
+            self.capture_and_enqueue()
+            # Never capture faster than processing gets through frames
+            remaining = self.scheduler.next_interval() - (time.perf_counter() - start_time)
+            if remaining > 0:
+                self.wake_event.wait(remaining)
+                self.wake_event.clear()
+
+    def processing_loop(self):
+        while True:
+            item = self.scheduler.take()
+            if item is None:
+                break
+            frame, capture_time = item
+            start_time = time.perf_counter()
+            self.process_image(*frame, capture_time)
+            self.scheduler.done(capture_time, start_time)
+
+    def grab_frame(self):
+        with METRICS.timer('grab'):
+            frame = self.frame_source.grab()
+        if frame:
+            img, window_position, crop = frame
+            # Ring frames record the screen position of their own top-left pixel
+            if crop is not None:
+                window_position = (window_position[0] + crop[0], window_position[1] + crop[1])
+            self.frame_ring.push(img, window_position, time.time())
+        return frame
 
     def capture_and_enqueue(self):
         try:
-            target_window = self.window_manager.get_target_window()
-            if target_window:
-                img, window_position = self.screenshot_manager.capture_window(target_window)
-                try:
-                    self.processing_queue.put_nowait((img, window_position))
-                except queue.Full:
-                    print("Processing queue is full. Skipping this frame.")
-            else:
-                print("Target window not found.")
+            capture_time = time.perf_counter()
+            frame = self.grab_frame()
+            if frame:
+                # Replaces a frame that no worker picked up yet
+                self.scheduler.submit(frame, capture_time)
         except Exception:
             print("Error in capture_and_enqueue:")
             print(traceback.format_exc())
 
-    def process_image(self, img, window_position):
+    def process_image(self, img, window_position, crop, capture_time):
         try:
-            timestamp, processed_img, log_entries = self.image_processor.process_image(img, window_position, self.template_manager.templates)
-            self.logger.write_log(timestamp, log_entries)
-            self.image_saver.save_processed_image(timestamp, processed_img)
-            if not isinstance(img, np.ndarray):
-                img = np.array(img)
+            with METRICS.timer('process'):
+                timestamp, frame_img, log_entries, record, annotations = self.image_processor.process_image(
+                    img, window_position, self.template_manager.templates, crop)
+            latency = time.perf_counter() - capture_time
+            METRICS.observe('latency', latency)
+            log_entries.append(f"LT: {latency * 1000:.1f} ms")
+            record['latency_ms'] = round(latency * 1000, 1)
+            with METRICS.timer('log'):
+                self.logger.log_frame(timestamp, log_entries, record)
+            if self.should_save_processed(record):
+                # The boxes are drawn by the writer thread, unsaved frames are never drawn on
+                with METRICS.timer('save'):
+                    self.image_saver.save_processed_image(timestamp, frame_img, annotations)
             
         except Exception:
             print("Error in process_image:")
             print(traceback.format_exc())
     
+# HOT RELOAD
+    def reload_loop(self):
+        while not self.reload_event.wait(self.config.hot_reload):
+            try:
+                self.reload_changes()
+            except Exception:
+                print("Error while reloading:")
+                print(traceback.format_exc())
+
+    def reload_changes(self):
+        start_time = time.perf_counter()
+        changes = {}
+
+        config_keys = self.reload_config()
+        if config_keys:
+            changes['config'] = config_keys
+
+        template_changes = self.template_manager.reload()
+        if template_changes is not None:
+            recompiled, removed = template_changes
+            changes['templates'] = recompiled
+            changes['removed'] = len(removed)
+            if self.image_processor.fft_engine is not None:
+                for name in removed:
+                    self.image_processor.fft_engine.forget(name)
+
+        pixel_checks = self.image_processor.reload_pixel_checks()
+        if pixel_checks is not None:
+            changes['pixel_checks'] = pixel_checks
+
+        if not changes:
+            return
+        if self.image_processor.match_pool is not None:
+            self.image_processor.match_pool.reload(self.image_processor.confidence_threshold)
+
+        elapsed = time.perf_counter() - start_time
+        METRICS.observe('reload', elapsed)
+        summary = ", ".join(f"{key}: {value}" for key, value in changes.items())
+        print(f"Reloaded in {elapsed * 1000:.1f} ms ({summary})")
+        timestamp = time.time()
+        self.logger.log_frame(timestamp, [f"Reload: {summary}", f"RT: {elapsed * 1000:.1f} ms"],
+                              {"timestamp": timestamp, "reload": changes, "reload_ms": round(elapsed * 1000, 1)})
+
+    def reload_config(self):
+        mtime = os.stat(self.config.config_file).st_mtime_ns
+        if mtime == self.config_mtime:
+            return None
+        config = Config(self.config.config_file)
+        self.config_mtime = mtime
+
+        applied = []
+        for key, value in vars(config).items():
+            if value == getattr(self.config, key):
+                continue
+            if key not in HOT_CONFIG_KEYS:
+                print(f"Config '{key}' changed, restart to apply it.")
+                continue
+            setattr(self.config, key, value)
+            applied.append(key)
+        self.image_processor.confidence_threshold = self.config.confidence_threshold
+        self.scheduler.min_interval = self.config.capture_interval
+        return applied
+
+    def should_save_processed(self, record):
+        # A template that stays high confidence (tracked or cached) is the same detection, only
+        # one turning high confidence since the previous frame is new
+        detected = {result['name'] for result in record['templates'] if result['high_confidence']}
+        new_detection = bool(detected - self.previous_detections)
+        self.previous_detections = detected
+        if self.config.save_processed == 'always':
+            return True
+        if self.config.save_processed == 'detection':
+            return new_detection
+        return False
+
 # RUNNER UTILS
 
     def stop_capture(self):
         print(f"Stop key '{self.stop_key}' pressed. Stopping capture...")
         self.running = False
+        self.wake_event.set()
+
+    def save_recent_frames(self):
+        saved = self.frame_ring.dump(self.image_writer)
+        print(f"Save key '{self.save_key}' pressed. Saving the last {saved} frames to screenshots/.")
+
+    def shutdown_components(self):
+        if self.image_processor.match_pool is not None:
+            self.image_processor.match_pool.shutdown()
+        self.logger.close()
+        self.image_writer.close()
+        self.frame_ring.flush()
+        print(f"Image writer: {self.image_writer.stats()}")
+        self.metrics_reporter.close()
 
     def toggle_pause(self):
         self.paused = not self.paused
+        self.wake_event.set()
         status = "paused" if self.paused else "resumed"
         print(f"Capture {status}.")
 
+# OFFLINE REPLAY, NO PACING SO END-TO-END FPS CAN BE MEASURED
+    def run_offline(self):
+        self.running = True
+        frames = 0
+        start_time = time.perf_counter()
+        try:
+            while self.running:
+                capture_time = time.perf_counter()
+                frame = self.grab_frame()
+                if frame is None:
+                    break
+                self.process_image(*frame, capture_time)
+                frames += 1
+        except KeyboardInterrupt:
+            self.stop_capture()
+        finally:
+            self.running = False
+            self.frame_source.close()
+            self.shutdown_components()
+            elapsed = time.perf_counter() - start_time
+            fps = frames / elapsed if elapsed > 0 else 0.0
+            print(f"Processed {frames} frames in {elapsed:.2f}s ({fps:.1f} FPS).")
+
 # MAIN LOOP
     def run(self):
+        if not self.frame_source.realtime:
+            self.run_offline()
+            return
+
+        import keyboard
+
         self.running = True
         print(f"Waiting 3 seconds before starting... Switch to window.")
         print(f"Press '{self.stop_key}' to stop the capture.")
         print(f"Press '{self.pause_key}' to pause/resume the capture.")
+        print(f"Press '{self.save_key}' to save the last {self.config.ring_capacity} frames.")
         time.sleep(3)
 
-        capture_thread = threading.Thread(target=self.capture_and_process_loop)
+        capture_thread = threading.Thread(target=self.capture_loop)
         capture_thread.start()
+        # One processing thread: tracking, cached results and change detection carry state from
+        # frame to frame, frames are processed in order. The templates of a frame are matched in parallel.
+        processing_thread = threading.Thread(target=self.processing_loop)
+        processing_thread.start()
+        reload_thread = None
+        if self.config.hot_reload:
+            reload_thread = threading.Thread(target=self.reload_loop, daemon=True)
+            reload_thread.start()
 
         # Set up the keyboard listeners
         keyboard.on_press_key(self.stop_key, lambda _: self.stop_capture())
         keyboard.on_press_key(self.pause_key, lambda _: self.toggle_pause())
+        keyboard.on_press_key(self.save_key, lambda _: self.save_recent_frames())
 
         try:
             while self.running:
@@ -123,8 +335,15 @@ class WindowCapture:
             print(traceback.format_exc())
         finally:
             self.running = False
+            self.wake_event.set()
+            self.reload_event.set()
+            if reload_thread is not None:
+                reload_thread.join()
             capture_thread.join()
-            self.executor.shutdown(wait=True)
+            self.scheduler.stop()
+            processing_thread.join()
+            self.shutdown_components()
+            print(f"Scheduler: {self.scheduler.stats()}")
             print("Capture stopped.")
 
 if __name__ == '__main__':
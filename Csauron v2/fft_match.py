@@ -0,0 +1,138 @@
+# FFT_MATCH.PY
+# Batched TM_CCOEFF_NORMED for templates that share a size. Each pyramid level is cut into
+# overlapping blocks that are transformed once, every template is then one spectrum multiply
+# and inverse transform per block. Template spectra are cached at block size, so memory does
+# not grow with the frame. The window statistics of the normalization come from integral
+# images and are shared by every template of the bucket.
+
+import threading
+
+import numpy as np
+import cv2
+
+from metrics import METRICS
+
+
+MIN_BLOCK = 256
+BLOCK_FACTOR = 4
+# Below this many templates of one size the shared transforms cost more than they save
+MIN_BUCKET = 4
+# OpenCV's 10 * FLT_EPSILON, relative to the window's sum of squares
+FLAT_EPSILON = 10 * np.finfo(np.float32).eps
+
+
+class FFTMatchEngine:
+    def __init__(self):
+        # (name, block_h, block_w) -> (template image, spectrum of the zero-mean template, norm)
+        self.spectra = {}
+        self.lock = threading.Lock()
+
+    def block_size(self, h, w, height, width):
+        # About 4x the template: fewer blocks than that waste calls, bigger ones waste transform size
+        block_h = min(cv2.getOptimalDFTSize(max(MIN_BLOCK, BLOCK_FACTOR * h)), cv2.getOptimalDFTSize(height))
+        block_w = min(cv2.getOptimalDFTSize(max(MIN_BLOCK, BLOCK_FACTOR * w)), cv2.getOptimalDFTSize(width))
+        return block_h, block_w
+
+    def template_spectrum(self, template, block_h, block_w):
+        key = (template.name, block_h, block_w)
+        cached = self.spectra.get(key)
+        if cached is not None and cached[0] is template.image:
+            return cached[1], cached[2]
+
+        pixels = template.image.astype(np.float32)
+        if template.norm:
+            # Precomputed by the template bank
+            mean, norm = template.mean, template.norm
+        else:
+            mean = float(pixels.mean())
+            norm = float(np.sqrt(((pixels - mean).astype(np.float64) ** 2).sum()))
+        zero_mean = pixels - np.float32(mean)
+        padded = np.zeros((block_h, block_w), dtype=np.float32)
+        padded[:pixels.shape[0], :pixels.shape[1]] = zero_mean
+        spectrum = cv2.dft(padded)
+        with self.lock:
+            self.spectra[key] = (template.image, spectrum, norm)
+        return spectrum, norm
+
+    def forget(self, name):
+        with self.lock:
+            for key in [key for key in self.spectra if key[0] == name]:
+                del self.spectra[key]
+
+    def match(self, pyramid, templates):
+        # Same result as ImageProcessor.match_template for every template, in order
+        h, w = templates[0].image.shape[:2]
+        found = [None] * len(templates)
+        for index in range(len(pyramid.scales)):
+            resized, r = pyramid.level(index)
+            if resized.shape[0] < h or resized.shape[1] < w:
+                break
+
+            with METRICS.timer('match_scale', template=f"fft {w}x{h} x{len(templates)}", scale=f"{pyramid.scales[index]:.2f}", search='fft'):
+                for i, score in enumerate(self.correlate(resized, templates)):
+                    _, maxVal, _, maxLoc = cv2.minMaxLoc(score)
+                    if found[i] is None or maxVal > found[i][0]:
+                        found[i] = (maxVal, maxLoc, r)
+
+        results = []
+        for result in found:
+            if result is None:
+                results.append(None)
+                continue
+            maxVal, maxLoc, r = result
+            startX, startY = int(maxLoc[0] * r), int(maxLoc[1] * r)
+            endX, endY = int((maxLoc[0] + w) * r), int((maxLoc[1] + h) * r)
+            results.append((startX, startY, endX, endY, 1/r, maxVal))
+        return results
+
+    def correlate(self, img_gray, templates):
+        # Yields the TM_CCOEFF_NORMED map of every template
+        height, width = img_gray.shape
+        h, w = templates[0].image.shape[:2]
+        out_h, out_w = height - h + 1, width - w + 1
+        block_h, block_w = self.block_size(h, w, height, width)
+        step_y, step_x = block_h - h + 1, block_w - w + 1
+        rows, cols = -(-out_h // step_y), -(-out_w // step_x)
+
+        # The templates are zero-mean, so the frame's mean does not change the correlation. Taking
+        # it out keeps the float32 transforms precise on low-contrast frames
+        padded = np.zeros(((rows - 1) * step_y + block_h, (cols - 1) * step_x + block_w), dtype=np.float32)
+        padded[:height, :width] = img_gray
+        padded[:height, :width] -= np.float32(cv2.mean(img_gray)[0])
+        blocks = [
+            (y, x, cv2.dft(padded[y:y + block_h, x:x + block_w]))
+            for y in range(0, rows * step_y, step_y)
+            for x in range(0, cols * step_x, step_x)
+        ]
+
+        # 1 / (window standard deviation * sqrt(window size)) in float64, shared by the whole bucket.
+        # Same guard as OpenCV: windows whose variance term is within rounding of 0 score 0
+        sums, square_sums = cv2.integral2(img_gray, sdepth=cv2.CV_64F)
+        window_sum = sums[h:, w:] - sums[:-h, w:] - sums[h:, :-w] + sums[:-h, :-w]
+        window_square_sum = square_sums[h:, w:] - square_sums[:-h, w:] - square_sums[h:, :-w] + square_sums[:-h, :-w]
+        window_variance = np.maximum(window_square_sum - window_sum * window_sum / (h * w), 0)
+        flat = window_variance <= np.minimum(0.5, FLAT_EPSILON * window_square_sum)
+        inverse_norm = np.zeros((out_h, out_w), dtype=np.float32)
+        np.divide(1.0, np.sqrt(window_variance), out=inverse_norm, where=~flat, casting='unsafe')
+
+        numerator = np.empty((rows * step_y, cols * step_x), dtype=np.float32)
+        for template in templates:
+            spectrum, norm = self.template_spectrum(template, block_h, block_w)
+            if norm == 0:
+                # Same as OpenCV, a flat template scores 1 everywhere
+                yield np.ones((out_h, out_w), dtype=np.float32)
+                continue
+            for y, x, block in blocks:
+                product = cv2.mulSpectrums(block, spectrum, 0, conjB=True)
+                correlation = cv2.idft(product, flags=cv2.DFT_REAL_OUTPUT | cv2.DFT_SCALE)
+                numerator[y:y + step_y, x:x + step_x] = correlation[:step_y, :step_x]
+            yield self.normalize(cv2.multiply(numerator[:out_h, :out_w], inverse_norm, scale=1.0 / norm))
+
+    def normalize(self, score):
+        # Same guard as OpenCV: a score can only leave [-1, 1] through rounding on (almost)
+        # flat windows, slightly outside is clamped to +-1 and far outside is 0
+        minVal, maxVal, _, _ = cv2.minMaxLoc(score)
+        if minVal <= -1 or maxVal >= 1:
+            over = np.abs(score) >= 1
+            score[over] = np.where(np.abs(score[over]) < 1.125, np.sign(score[over]), 0)
+        return score
@@ -0,0 +1,168 @@
+# FRAME_SOURCES.PY
+
+import os
+import cv2
+import numpy as np
+
+from metrics import METRICS
+
+
+## BASE
+# grab() returns (img, window_position, crop) or None when no frame is available.
+# img is a BGRA (live capture) or BGR numpy array. crop is None for the whole window, or
+# (x0, y0, window width, window height) when img only covers the window from (x0, y0).
+# Realtime sources are paced by capture_interval, offline ones are read as fast as possible.
+class FrameSource:
+    realtime = True
+
+    def __init__(self):
+        self.finished = False
+        # Optional callable (window width, window height) -> (x0, y0, x1, y1) in window pixels, None for everything
+        self.capture_box = None
+
+    def grab(self):
+        raise NotImplementedError
+
+    def crop(self, img, window_position):
+        # Offline frames are whole windows, cut to the capture box the same way as a live grab
+        height, width = img.shape[:2]
+        box = self.capture_box(width, height) if self.capture_box else None
+        if box is None:
+            return img, window_position, None
+        x0, y0, x1, y1 = box
+        return img[y0:y1, x0:x1], window_position, (x0, y0, width, height)
+
+    def close(self):
+        pass
+
+
+## LIVE WINDOW
+class WindowFrameSource(FrameSource):
+    def __init__(self, window_manager, screenshot_manager):
+        super().__init__()
+        self.window_manager = window_manager
+        self.screenshot_manager = screenshot_manager
+
+    def grab(self):
+        with METRICS.timer('window_lookup'):
+            target_window = self.window_manager.get_target_window()
+        if not target_window:
+            print("Target window not found.")
+            return None
+        # The window manager already read the rect while validating its cached window
+        window_rect = self.window_manager.window_rect
+        width, height = window_rect[2] - window_rect[0], window_rect[3] - window_rect[1]
+        box = self.capture_box(width, height) if self.capture_box else None
+        img, window_position = self.screenshot_manager.capture_window(target_window, window_rect, box)
+        crop = (box[0], box[1], width, height) if box is not None else None
+        return img, window_position, crop
+
+
+## OFFLINE REPLAY (DIRECTORY OF IMAGES OR VIDEO FILE)
+class ReplayFrameSource(FrameSource):
+    realtime = False
+
+    def __init__(self, path, loop=False):
+        super().__init__()
+        self.path = path
+        self.loop = loop
+        self.files = None
+        self.video = None
+        self.index = 0
+
+        if os.path.isdir(path):
+            self.files = sorted(
+                os.path.join(path, filename) for filename in os.listdir(path)
+                if filename.lower().endswith(('.png', '.jpg', '.jpeg'))
+            )
+            if not self.files:
+                raise ValueError(f"No images found in replay directory: {path}")
+        elif os.path.isfile(path):
+            self.video = cv2.VideoCapture(path)
+            if not self.video.isOpened():
+                raise ValueError(f"Could not open replay video: {path}")
+        else:
+            raise ValueError(f"Replay source not found: {path}")
+
+    def grab(self):
+        img_bgr = self.read_video_frame() if self.video is not None else self.read_image_file()
+        if img_bgr is None:
+            self.finished = True
+            return None
+        return self.crop(img_bgr, (0, 0))
+
+    def read_image_file(self):
+        while True:
+            if self.index >= len(self.files):
+                if not self.loop:
+                    return None
+                self.index = 0
+            file_path = self.files[self.index]
+            self.index += 1
+            img_bgr = cv2.imread(file_path, cv2.IMREAD_COLOR)
+            if img_bgr is not None:
+                return img_bgr
+            print(f"Warning: Could not load replay frame {file_path}")
+
+    def read_video_frame(self):
+        ok, img_bgr = self.video.read()
+        if not ok and self.loop:
+            self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, img_bgr = self.video.read()
+        return img_bgr if ok else None
+
+    def close(self):
+        if self.video is not None:
+            self.video.release()
+
+
+## SYNTHETIC FRAMES WITH TEMPLATES AT KNOWN POSITIONS AND SCALES
+class SyntheticFrameSource(FrameSource):
+    realtime = False
+
+    def __init__(self, templates, width=1280, height=720, frames=100, scales=(1.0, 0.65), jitter=0, seed=0):
+        super().__init__()
+        self.templates = templates
+        self.width = width
+        self.height = height
+        self.frames = frames
+        self.jitter = jitter
+        self.rng = np.random.default_rng(seed)
+        self.count = 0
+
+        # Smooth noise background, upscaled so it does not correlate with the templates
+        noise = self.rng.integers(0, 256, (height // 16 + 1, width // 16 + 1, 3), dtype=np.uint8)
+        self.background = cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC)
+
+        # A template matched at frame scale s appears 1/s times its size in the frame
+        self.placements = []
+        for i, template in enumerate(templates):
+            scale = scales[i % len(scales)]
+            h, w = template.image.shape[:2]
+            pasted = cv2.resize(template.image, (int(w / scale), int(h / scale)))
+            if pasted.shape[0] >= height or pasted.shape[1] >= width:
+                print(f"Warning: Template {template.name} does not fit in a {width}x{height} synthetic frame")
+                continue
+            x = int(self.rng.integers(0, width - pasted.shape[1]))
+            y = int(self.rng.integers(0, height - pasted.shape[0]))
+            self.placements.append((template.name, cv2.cvtColor(pasted, cv2.COLOR_GRAY2BGR), x, y, scale))
+
+        # (name, startX, startY, endX, endY, scale) for the last generated frame
+        self.ground_truth = []
+
+    def grab(self):
+        if self.frames is not None and self.count >= self.frames:
+            self.finished = True
+            return None
+        self.count += 1
+
+        img = self.background.copy()
+        self.ground_truth = []
+        for name, pasted, x, y, scale in self.placements:
+            if self.jitter:
+                x = int(np.clip(x + self.rng.integers(-self.jitter, self.jitter + 1), 0, self.width - pasted.shape[1]))
+                y = int(np.clip(y + self.rng.integers(-self.jitter, self.jitter + 1), 0, self.height - pasted.shape[0]))
+            h, w = pasted.shape[:2]
+            img[y:y + h, x:x + w] = pasted
+            self.ground_truth.append((name, x, y, x + w, y + h, scale))
+        return self.crop(img, (0, 0))
@@ -0,0 +1,140 @@
+# IMPORT_REPORT.PY
+# Cold start of the runner for a templates-plus-pixel-checks setup: a fresh interpreter imports csauron
+# and builds WindowCapture on a synthetic source with generated templates and pixel checks, under
+# python -X importtime. Live capture, metrics HTTP and the process pool dependencies are loaded on use,
+# this start must not import them and must stay under STARTUP_BUDGET_MS.
+#   python import_report.py
+#   python import_report.py --templates 100 --output startup.json
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+import cv2
+import numpy as np
+
+
+# Median cold start (import and WindowCapture construction), the report fails above it
+STARTUP_BUDGET_MS = 400
+# Loaded only by the stage that needs them
+LAZY_MODULES = (
+    'win32', 'psutil', 'mss', 'keyboard', 'PIL', 'torch', 'torchvision',
+    'http.server', 'multiprocessing.shared_memory', 'concurrent.futures.process',
+)
+
+# Runs in the fresh interpreter, prints one JSON line after the startup
+STARTUP_SCRIPT = """
+import json, sys, time
+start_time = time.perf_counter()
+from csauron import WindowCapture
+window_capture = WindowCapture('config.json')
+startup_ms = (time.perf_counter() - start_time) * 1000
+lazy = [name for name in {lazy!r} if name in sys.modules]
+print(json.dumps({{"startup_ms": startup_ms, "templates": len(window_capture.template_manager.templates),
+                  "pixel_checks": len(window_capture.image_processor.pixel_checks), "lazy_loaded": lazy}}))
+"""
+
+
+## SETUP
+def write_setup(workdir, templates, pixel_checks, seed=0):
+    rng = np.random.default_rng(seed)
+    template_dir = os.path.join(workdir, 'templates')
+    os.makedirs(template_dir)
+    for i in range(templates):
+        noise = rng.integers(0, 256, (8, 8), dtype=np.uint8)
+        cv2.imwrite(os.path.join(template_dir, f'template_{i}.png'), cv2.resize(noise, (64, 64), interpolation=cv2.INTER_CUBIC))
+
+    checks = [{"range": [[170, 170, 170], [255, 255, 255]], "state": "White"}]
+    with open(os.path.join(workdir, 'pixel_checks.json'), 'w') as f:
+        json.dump({"pixel_checks": [
+            {"name": f"probe_{i}", "position": [int(rng.integers(0, 1280)), int(rng.integers(0, 720))], "checks": checks}
+            for i in range(pixel_checks)
+        ]}, f)
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump({
+            "template_dir": template_dir,
+            "frame_source": {"type": "synthetic", "frames": 1, "width": 1280, "height": 720},
+            "metrics": {"interval": 0},
+        }, f)
+
+
+## MEASURE
+def measure(workdir):
+    # Returns (startup result, {imported module: (self us, cumulative us)}) for one cold start
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), os.environ.get('PYTHONPATH')])))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', STARTUP_SCRIPT.format(lazy=LAZY_MODULES)],
+        cwd=workdir, env=env, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Startup failed:\n{result.stderr}")
+    timings = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return json.loads(result.stdout.strip().splitlines()[-1]), timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the cold start of the runner and check it against a budget.")
+    parser.add_argument('--templates', type=int, default=20)
+    parser.add_argument('--pixel-checks', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=5, help="Fresh interpreters, the median is reported")
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--budget', type=float, default=STARTUP_BUDGET_MS, help="Startup in ms above which the report fails")
+    parser.add_argument('--output', help="Write the median timings as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        write_setup(workdir, args.templates, args.pixel_checks)
+        runs = [measure(workdir) for _ in range(args.repeat)]
+
+    startup_ms = statistics.median(startup["startup_ms"] for startup, _ in runs)
+    loaded = sorted({name for startup, _ in runs for name in startup["lazy_loaded"]})
+    names = set.intersection(*(set(timings) for _, timings in runs))
+    median = {
+        name: (statistics.median(timings[name][0] for _, timings in runs), statistics.median(timings[name][1] for _, timings in runs))
+        for name in names
+    }
+
+    startup = runs[0][0]
+    import_ms = median['csauron'][1] / 1000
+    print(f"Startup with {startup['templates']} templates and {startup['pixel_checks']} pixel checks: "
+          f"{startup_ms:.1f} ms, import csauron {import_ms:.1f} ms (median of {args.repeat})")
+    for name, (self_us, cumulative_us) in sorted(median.items(), key=lambda item: item[1][0], reverse=True)[:args.top]:
+        print(f"  {name}: self {self_us / 1000:.1f} ms, cumulative {cumulative_us / 1000:.1f} ms")
+
+    failures = []
+    if loaded:
+        failures.append(f"lazy dependencies imported at start: {', '.join(loaded)}")
+    if startup_ms > args.budget:
+        failures.append(f"{startup_ms:.1f} ms is over the {args.budget:.0f} ms budget")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                "python": sys.version.split()[0],
+                "templates": startup["templates"],
+                "pixel_checks": startup["pixel_checks"],
+                "startup_ms": startup_ms,
+                "import_ms": import_ms,
+                "budget_ms": args.budget,
+                "lazy_loaded": loaded,
+                "modules": {name: {"self_us": s, "cumulative_us": c} for name, (s, c) in median.items()},
+            }, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
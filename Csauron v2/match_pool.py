@@ -0,0 +1,168 @@
+# MATCH_POOL.PY
+# Process pool backend for template matching. Python-level loops hold the GIL, so worker
+# processes are used instead of threads. Each frame is copied once into shared memory and
+# workers read it from there, the image itself is never pickled.
+
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from capture_utils import TemplateManager
+from capture_processor import ImageProcessor, ScalePyramid
+from metrics import METRICS
+
+
+## WORKER SIDE
+# Loaded once per worker process by the pool initializer
+_worker_manager = None
+_worker_templates = {}
+_worker_processor = None
+_worker_generation = 0
+
+
+def _init_worker(template_dir, metadata_file, bank_file, confidence_threshold, scales, match_engine):
+    global _worker_manager, _worker_templates, _worker_processor
+    # With a bank every worker maps the same file, the images are shared through the page cache
+    _worker_manager = TemplateManager(template_dir, metadata_file, bank_file)
+    _worker_templates = {template.name: template for template in _worker_manager.templates}
+    _worker_processor = ImageProcessor(confidence_threshold, pixel_checks_file=None, scales=scales, match_engine=match_engine)
+    # Match timings go back to the main process with the results
+    METRICS.record()
+
+
+def _sync_worker(generation, confidence_threshold):
+    # The main process reloaded, catch up from the same files before matching
+    global _worker_templates, _worker_generation
+    _worker_processor.confidence_threshold = confidence_threshold
+    if generation != _worker_generation:
+        _worker_manager.reload()
+        _worker_templates = {template.name: template for template in _worker_manager.templates}
+        _worker_generation = generation
+
+
+def _match_group(shm_name, shape, crop, items, generation, confidence_threshold):
+    _sync_worker(generation, confidence_threshold)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        img_gray = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        pyramid = ScalePyramid(img_gray, _worker_processor.scales, crop)
+        templates = []
+        counters = {}
+        for name, last_match in items:
+            template = _worker_templates.get(name)
+            if template is None:
+                continue
+            # Tracking state lives in the main process and travels with the task
+            template.last_match = last_match
+            counters[name] = (template.track_hits, template.track_misses)
+            templates.append(template)
+
+        matched = _worker_processor.match_pending(pyramid, templates)
+        results = []
+        for name, _ in items:
+            template = _worker_templates.get(name)
+            if template is None:
+                results.append((name, None, None, 0, 0))
+                continue
+            hits, misses = counters[name]
+            results.append((name, matched[name], template.last_match,
+                            template.track_hits - hits, template.track_misses - misses))
+        resizes_skipped = pyramid.resizes_skipped
+        pyramid.release()
+        del img_gray
+        return results, resizes_skipped, METRICS.drain()
+    finally:
+        shm.close()
+
+
+## MAIN PROCESS SIDE
+class SharedFramePool:
+    def __init__(self, max_free=8):
+        self.max_free = max_free
+        self.free = []
+        self.lock = threading.Lock()
+
+    def acquire(self, nbytes):
+        with self.lock:
+            for shm in self.free:
+                if shm.size >= nbytes:
+                    self.free.remove(shm)
+                    return shm
+        return shared_memory.SharedMemory(create=True, size=nbytes)
+
+    def release(self, shm):
+        with self.lock:
+            if len(self.free) < self.max_free:
+                self.free.append(shm)
+                return
+        shm.close()
+        shm.unlink()
+
+    def close(self):
+        with self.lock:
+            for shm in self.free:
+                shm.close()
+                shm.unlink()
+            self.free.clear()
+
+
+class ProcessMatchPool:
+    def __init__(self, template_dir, confidence_threshold, scales, metadata_file='templates_metadata.json', workers=None, bank_file=None,
+                 match_engine='opencv'):
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_worker,
+            initargs=(template_dir, metadata_file, bank_file, confidence_threshold, list(scales), match_engine),
+        )
+        self.frames = SharedFramePool()
+        self.generation = 0
+        self.confidence_threshold = confidence_threshold
+
+    def reload(self, confidence_threshold):
+        # Workers reload on their next task
+        self.generation += 1
+        self.confidence_threshold = confidence_threshold
+
+    def match_templates(self, img_gray, templates, crop=None):
+        shm = self.frames.acquire(img_gray.nbytes)
+        try:
+            frame = np.ndarray(img_gray.shape, dtype=np.uint8, buffer=shm.buf)
+            frame[:] = img_gray
+            del frame
+
+            by_name = {template.name: template for template in templates}
+            groups = [templates[i::self.workers] for i in range(min(self.workers, len(templates)))]
+            futures = [
+                self.executor.submit(_match_group, shm.name, img_gray.shape, crop,
+                                     [(template.name, template.last_match) for template in group],
+                                     self.generation, self.confidence_threshold)
+                for group in groups
+            ]
+
+            # Every worker must be done with the block before it goes back to the pool
+            wait(futures)
+            matched = {}
+            resizes_skipped = 0
+            for future in futures:
+                results, skipped, observations = future.result()
+                for name, match_result, last_match, hits, misses in results:
+                    template = by_name[name]
+                    template.last_match = last_match
+                    template.track_hits += hits
+                    template.track_misses += misses
+                    matched[name] = match_result
+                resizes_skipped += skipped
+                for stage, seconds, labels in observations:
+                    METRICS.observe(stage, seconds, **labels)
+            # Results by template name, and the resizes the worker pyramids skipped
+            return matched, resizes_skipped
+        finally:
+            self.frames.release(shm)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.frames.close()
@@ -0,0 +1,170 @@
+# METRICS.PY
+# Per-stage timings with rolling percentiles. Every stage keeps its last samples per label set,
+# plus a running count and sum. Readable as a periodic summary, a Prometheus text file
+# or a local http://127.0.0.1:<port>/metrics endpoint.
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+
+QUANTILES = (0.5, 0.95, 0.99)
+WINDOW = 1024
+
+
+class StageMetrics:
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        # (stage, ((label, value), ...)) -> [samples, count, sum]
+        self.stages = {}
+        # (stage, seconds, labels) of every observation while recording, see drain
+        self.recorded = None
+
+    def observe(self, stage, seconds, **labels):
+        key = (stage, tuple(sorted(labels.items())))
+        with self.lock:
+            entry = self.stages.get(key)
+            if entry is None:
+                entry = self.stages[key] = [deque(maxlen=self.window), 0, 0.0]
+            entry[0].append(seconds)
+            entry[1] += 1
+            entry[2] += seconds
+            if self.recorded is not None:
+                self.recorded.append((stage, seconds, labels))
+
+    def record(self):
+        # Keep every observation from now on until it is drained, worker processes forward them this way
+        with self.lock:
+            self.recorded = []
+
+    def drain(self):
+        with self.lock:
+            recorded, self.recorded = self.recorded, []
+        return recorded
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start_time, **labels)
+
+    def snapshot(self):
+        with self.lock:
+            entries = [(key, np.array(samples), count, total) for key, (samples, count, total) in self.stages.items()]
+        snapshot = []
+        for (stage, labels), samples, count, total in entries:
+            quantiles = np.quantile(samples, QUANTILES) if len(samples) else [0.0] * len(QUANTILES)
+            snapshot.append({
+                "stage": stage,
+                "labels": dict(labels),
+                "count": count,
+                "sum": total,
+                "quantiles": dict(zip(QUANTILES, (float(q) for q in quantiles))),
+            })
+        return snapshot
+
+    def format_summary(self, limit=20):
+        # Largest total time first, that is where the frame budget goes
+        lines = []
+        for entry in sorted(self.snapshot(), key=lambda e: e["sum"], reverse=True)[:limit]:
+            labels = ",".join(f"{k}={v}" for k, v in entry["labels"].items())
+            name = f"{entry['stage']}{{{labels}}}" if labels else entry["stage"]
+            q = entry["quantiles"]
+            lines.append(f"{name}: n={entry['count']} p50 {q[0.5] * 1000:.2f} p95 {q[0.95] * 1000:.2f} "
+                         f"p99 {q[0.99] * 1000:.2f} ms, total {entry['sum']:.2f}s")
+        return "\n".join(lines)
+
+    def prometheus_text(self):
+        lines = [
+            "# HELP csauron_stage_seconds Time spent per pipeline stage.",
+            "# TYPE csauron_stage_seconds summary",
+        ]
+        for entry in self.snapshot():
+            labels = ",".join([f'stage="{entry["stage"]}"'] + [f'{k}="{v}"' for k, v in entry["labels"].items()])
+            for quantile, value in entry["quantiles"].items():
+                lines.append(f'csauron_stage_seconds{{{labels},quantile="{quantile}"}} {value:.6f}')
+            lines.append(f'csauron_stage_seconds_sum{{{labels}}} {entry["sum"]:.6f}')
+            lines.append(f'csauron_stage_seconds_count{{{labels}}} {entry["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        # Written next to the target and renamed, readers never see half a file
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(temp_path, path)
+
+
+# Shared by every component of the process
+METRICS = StageMetrics()
+
+
+## REPORTING
+class MetricsReporter:
+    def __init__(self, metrics, interval=60, prometheus_file=None, port=None):
+        self.metrics = metrics
+        self.interval = interval
+        self.prometheus_file = prometheus_file
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.server = None
+
+        if port:
+            from http.server import ThreadingHTTPServer
+            self.server = ThreadingHTTPServer(('127.0.0.1', port), self.make_handler())
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            print(f"Metrics served on http://127.0.0.1:{port}/metrics")
+
+        if interval:
+            self.thread = threading.Thread(target=self.report_loop, daemon=True)
+            self.thread.start()
+
+    def make_handler(self):
+        from http.server import BaseHTTPRequestHandler
+        metrics = self.metrics
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return MetricsHandler
+
+    def report_loop(self):
+        while not self.stop_event.wait(self.interval):
+            self.report()
+
+    def report(self):
+        try:
+            print(f"Stage timings:\n{self.metrics.format_summary()}")
+            if self.prometheus_file:
+                self.metrics.write_prometheus(self.prometheus_file)
+        except Exception as e:
+            print(f"Error writing metrics: {e}")
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        self.report()
@@ -0,0 +1,87 @@
+# SCHEDULER.PY
+# Latest-frame-wins handoff between the capture thread and the processing thread.
+# Only the newest frame is kept, a frame that was not picked up before the next capture
+# is dropped. The capture interval follows the measured processing time, so capture
+# never runs ahead of what processing can handle.
+
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+
+class LatestFrameScheduler:
+    def __init__(self, min_interval, smoothing=0.2, history=200):
+        self.min_interval = min_interval
+        self.smoothing = smoothing
+        self.condition = threading.Condition()
+        self.latest = None
+        self.running = True
+        self.submitted = 0
+        self.dropped = 0
+        self.processed = 0
+        # Moving average of processing time per frame
+        self.processing_time = None
+        self.latencies = deque(maxlen=history)
+
+    def submit(self, frame, capture_time):
+        with self.condition:
+            if self.latest is not None:
+                self.dropped += 1
+            self.latest = (frame, capture_time)
+            self.submitted += 1
+            self.condition.notify()
+
+    def take(self):
+        # Blocks until a frame is ready, returns None once stopped
+        with self.condition:
+            while self.running and self.latest is None:
+                self.condition.wait()
+            if not self.running:
+                return None
+            item, self.latest = self.latest, None
+            return item
+
+    def done(self, capture_time, start_time):
+        end_time = time.perf_counter()
+        duration = end_time - start_time
+        latency = end_time - capture_time
+        with self.condition:
+            self.processed += 1
+            if self.processing_time is None:
+                self.processing_time = duration
+            else:
+                self.processing_time += self.smoothing * (duration - self.processing_time)
+            self.latencies.append(latency)
+        return latency
+
+    def next_interval(self):
+        with self.condition:
+            return self.interval()
+
+    def interval(self):
+        # Caller holds the condition
+        if self.processing_time is None:
+            return self.min_interval
+        return max(self.min_interval, self.processing_time)
+
+    def stats(self):
+        with self.condition:
+            latencies = np.array(self.latencies) * 1000
+            return {
+                "submitted": self.submitted,
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "interval_ms": self.interval() * 1000,
+                "latency_ms": {
+                    "p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                    "p95": float(np.percentile(latencies, 95)) if len(latencies) else None,
+                    "max": float(latencies.max()) if len(latencies) else None,
+                },
+            }
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
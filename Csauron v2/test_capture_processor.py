@@ -0,0 +1,31 @@
+# TEST_CAPTURE_PROCESSOR.PY
+#   python -m pytest -q
+
+import json
+
+import numpy as np
+
+from capture_processor import ImageProcessor
+
+
+## PIXEL CHECKS
+def test_pixel_checks_keep_probes_with_the_same_name(tmp_path):
+    checks = [{"range": [[170, 170, 170], [255, 255, 255]], "state": "White"}]
+    pixel_checks_file = tmp_path / 'pixel_checks.json'
+    pixel_checks_file.write_text(json.dumps({"pixel_checks": [
+        {"name": "health", "position": [1, 1], "checks": checks},
+        {"name": "health", "position": [5, 5], "checks": checks},
+        {"name": "stamina", "position": [8, 2], "checks": checks},
+    ]}))
+    processor = ImageProcessor(0.8, pixel_checks_file=str(pixel_checks_file))
+    img = np.zeros((10, 10, 4), dtype=np.uint8)
+    img[1, 1] = 255
+    img[2, 8] = 40
+
+    try:
+        assert processor.check_pixels(img) == [("health", "White"), ("health", "DEAD"), ("stamina", "Unknown")]
+        _, _, log_entries, record, _ = processor.process_image(img, (0, 0), [])
+    finally:
+        processor.executor.shutdown()
+    assert log_entries[:3] == ["health: White\n", "health: DEAD\n", "stamina: Unknown\n"]
+    assert [check["state"] for check in record["pixel_checks"]] == ["White", "DEAD", "Unknown"]
@@ -0,0 +1,95 @@
+# TEST_CAPTURE_UTILS.PY
+#   python -m pytest -q
+
+import weakref
+
+import numpy as np
+
+from capture_utils import FakeWindowBackend, FrameRingBuffer, WindowManager
+
+
+## FRAME RING BUFFER
+def test_ring_buffer_grows_memory_mapped_file(tmp_path):
+    mmap_file = str(tmp_path / 'ring.npy')
+    ring = FrameRingBuffer(capacity=3, mmap_file=mmap_file)
+    small = np.full((20, 30, 4), 7, dtype=np.uint8)
+    ring.push(small, (0, 0), 1.0)
+    old_frames = weakref.ref(ring.frames)
+    old_meta = weakref.ref(ring.meta)
+
+    large = np.full((40, 50, 4), 9, dtype=np.uint8)
+    ring.push(large, (5, 6), 2.0)
+
+    # The old maps are released before the file is opened again
+    assert old_frames() is None and old_meta() is None
+    assert ring.frames.shape == (3, 40, 50, 4)
+    # Frames from before the growth are dropped, the new one is stored whole
+    frames = ring.latest()
+    assert len(frames) == 1
+    img, window_position, timestamp = frames[0]
+    assert np.array_equal(img, large) and window_position == (5, 6) and timestamp == 2.0
+
+    ring.push(small, (0, 0), 3.0)
+    ring.flush()
+    stored = np.load(mmap_file, mmap_mode='r')
+    assert stored.shape == (3, 40, 50, 4)
+    assert np.array_equal(stored[2, :20, :30], small)
+
+
+## WINDOW MANAGER
+def make_backend():
+    return FakeWindowBackend(
+        windows={
+            1: {"title": "Other", "pid": 10, "rect": (0, 0, 800, 600)},
+            2: {"title": "Game", "pid": 20, "rect": (100, 50, 1380, 770)},
+        },
+        processes={10: "explorer.exe", 20: "game.exe"},
+    )
+
+
+def test_window_manager_caches_resolved_window():
+    backend = make_backend()
+    window_manager = WindowManager('GAME.exe', backend=backend)
+
+    assert window_manager.get_target_window() == 2
+    assert window_manager.get_target_window() == 2
+    assert window_manager.enumerations == 1
+    assert (window_manager.pid, window_manager.window_rect) == (20, (100, 50, 1380, 770))
+
+
+def test_window_manager_resolves_again_when_window_moves():
+    backend = make_backend()
+    window_manager = WindowManager('game.exe', backend=backend)
+    window_manager.get_target_window()
+
+    backend.windows[2]["rect"] = (200, 80, 1480, 800)
+    assert window_manager.get_target_window() == 2
+    assert window_manager.enumerations == 2
+    assert window_manager.window_rect == (200, 80, 1480, 800)
+
+
+def test_window_manager_drops_window_when_process_changes():
+    backend = make_backend()
+    window_manager = WindowManager('game.exe', backend=backend)
+    window_manager.get_target_window()
+
+    # Handle reused by another process, the game is now another window
+    backend.windows[2]["pid"] = 10
+    backend.windows[3] = {"title": "Game", "pid": 30, "rect": (0, 0, 640, 480)}
+    backend.processes[30] = "game.exe"
+    assert window_manager.get_target_window() == 3
+    assert (window_manager.pid, window_manager.window_rect) == (30, (0, 0, 640, 480))
+
+
+def test_window_manager_forgets_closed_window():
+    backend = make_backend()
+    window_manager = WindowManager('game.exe', backend=backend)
+    window_manager.get_target_window()
+
+    del backend.windows[2]
+    assert window_manager.get_target_window() is None
+    assert (window_manager.hwnd, window_manager.pid, window_manager.window_rect) == (None, None, None)
+    # Hidden or untitled windows are not candidates
+    backend.windows[4] = {"title": "Game", "pid": 20, "rect": (0, 0, 10, 10), "visible": False}
+    backend.windows[5] = {"title": "", "pid": 20, "rect": (0, 0, 10, 10)}
+    assert window_manager.get_target_window() is None
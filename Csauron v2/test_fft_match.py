@@ -0,0 +1,60 @@
+# TEST_FFT_MATCH.PY
+#   python -m pytest -q
+
+import cv2
+import numpy as np
+import pytest
+
+from capture_utils import Template
+from fft_match import FFTMatchEngine
+
+
+def make_frames():
+    rng = np.random.default_rng(3)
+    natural = cv2.resize(rng.integers(0, 256, (36, 64), dtype=np.uint8), (640, 360), interpolation=cv2.INTER_CUBIC)
+    low = (100 + natural // 32).astype(np.uint8)
+    return natural, low
+
+
+def make_cases():
+    natural, low = make_frames()
+    flat = np.full((24, 32), 90, dtype=np.uint8)
+    near_flat = np.full((24, 32), 103, dtype=np.uint8)
+    near_flat[5:9, 6:12] += 1
+    near_flat[15:18, 20:26] -= 1
+    return {
+        'flat on natural': (natural, flat),
+        'flat on low contrast': (low, flat),
+        'near-flat on natural': (natural, near_flat),
+        'near-flat on low contrast': (low, near_flat),
+        'low-contrast crop': (low, low[200:224, 300:332].copy()),
+        'near-flat crop': (low, (low[100:124, 40:72] // 2 + 50).astype(np.uint8)),
+    }
+
+
+## SAME SCORES AS OPENCV
+@pytest.mark.parametrize('case', list(make_cases()))
+def test_scores_match_opencv(case):
+    img_gray, image = make_cases()[case]
+    expected = cv2.matchTemplate(img_gray, image, cv2.TM_CCOEFF_NORMED)
+    template = Template(case, image, 'test', 0)
+    score = next(FFTMatchEngine().correlate(img_gray, [template]))
+
+    assert score.shape == expected.shape
+    _, expected_max, _, expected_loc = cv2.minMaxLoc(expected)
+    _, max_val, _, max_loc = cv2.minMaxLoc(score)
+    assert max_loc == expected_loc
+    assert max_val == pytest.approx(expected_max, abs=1e-3)
+    # OpenCV correlates the raw pixels in float32, near-flat templates leave it this much rounding
+    assert np.abs(score - expected).max() < 0.02
+
+
+def test_flat_windows_score_zero():
+    img_gray = make_frames()[0].copy()
+    img_gray[100:200, 100:300] = 140
+    image = img_gray[10:34, 20:52].copy()
+    expected = cv2.matchTemplate(img_gray, image, cv2.TM_CCOEFF_NORMED)
+    score = next(FFTMatchEngine().correlate(img_gray, [Template('flat windows', image, 'test', 0)]))
+
+    assert not expected[100:177, 100:269].any()
+    assert not score[100:177, 100:269].any()
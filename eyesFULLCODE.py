@@ -87,11 +87,67 @@ class ScreenshotManager:
         img = Image.frombytes("RGB", screenshot.size, screenshot.rgb)
         return img, (left, top)
 
+# Scale pyramid shared by all templates for one frame
+SCALES = np.linspace(0.2, 1.0, 20)[::-1]
+
+CHANGE_SIZE = (320, 180)
+CHANGE_GRID = (32, 18)
+CHANGE_NOISE = 30
+
+# Change detection on a small area-averaged frame, heatmap is the percentage of changed pixels per tile
+class ChangeDetector:
+    def __init__(self, size=CHANGE_SIZE, grid=CHANGE_GRID, noise_threshold=CHANGE_NOISE, hot_threshold=5):
+        self.size = size
+        self.grid = grid
+        self.noise_threshold = noise_threshold
+        self.hot_threshold = hot_threshold
+        self.previous = None
+        self.heatmap = None
+        self.hot_tiles = None
+
+    def update(self, img_gray):
+        # Returns (change percentage, hot tiles as (row, col) pairs), (None, None) on the first frame
+        small = cv2.resize(img_gray, self.size, interpolation=cv2.INTER_AREA)
+        result = (None, None)
+        if self.previous is not None:
+            frame_diff = cv2.absdiff(self.previous, small)
+            _, changed = cv2.threshold(frame_diff, self.noise_threshold, 100, cv2.THRESH_BINARY)
+            self.heatmap = cv2.resize(changed.astype(np.float32), self.grid, interpolation=cv2.INTER_AREA)
+            self.hot_tiles = np.argwhere(self.heatmap > self.hot_threshold)
+            result = (float(self.heatmap.mean()), self.hot_tiles)
+        self.previous = small
+        return result
+
+class ScalePyramid:
+    def __init__(self, img_gray, scales=SCALES):
+        self.img_gray = img_gray
+        self.scales = scales
+        self.levels = {}
+        self.requests = 0
+
+    def level(self, index):
+        self.requests += 1
+        if index not in self.levels:
+            scale = self.scales[index]
+            resized = cv2.resize(self.img_gray, (int(self.img_gray.shape[1] * scale), int(self.img_gray.shape[0] * scale)))
+            resized.flags.writeable = False
+            r = self.img_gray.shape[1] / float(resized.shape[1])
+            self.levels[index] = (resized, r)
+        return self.levels[index]
+
+    @property
+    def resizes_skipped(self):
+        return self.requests - len(self.levels)
+
+    def release(self):
+        self.levels.clear()
+        self.img_gray = None
+
 # Processing
 class ImageProcessor:
     def __init__(self, confidence_threshold):
         self.confidence_threshold = confidence_threshold
-        self.previous_frame = None
+        self.change_detector = ChangeDetector()
 
     def process_image(self, img, window_position, templates):
         img_cv = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
@@ -101,9 +157,10 @@ class ImageProcessor:
         
         timestamp = time.time()
         log_entries = []
+        pyramid = ScalePyramid(img_gray)
         
         for template_name, template in templates:
-            match_result = self.match_template(img_gray, template)
+            match_result = self.match_template(pyramid, template)
             if match_result:
                 startX, startY, endX, endY, scale, confidence = match_result
                 abs_startX, abs_startY = window_position[0] + startX, window_position[1] + startY
@@ -123,23 +180,21 @@ class ImageProcessor:
             else:
                 log_entries.append(f"No match found for template {template_name}")
         
-        if self.previous_frame is not None:
-            frame_diff = cv2.absdiff(self.previous_frame, img_gray)
-            _, thresh = cv2.threshold(frame_diff, 30, 255, cv2.THRESH_BINARY)
-            
-            change_percentage = (np.sum(thresh) / 255) / (thresh.shape[0] * thresh.shape[1]) * 100
-            log_entries.append(f"Change significance: {change_percentage:.2f}%")
+        log_entries.append(f"Resizes skipped: {pyramid.resizes_skipped}")
+        pyramid.release()
         
-        self.previous_frame = img_gray
+        change_percentage, hot_tiles = self.change_detector.update(img_gray)
+        if change_percentage is not None:
+            log_entries.append(f"Change significance: {change_percentage:.2f}%")
+            log_entries.append(f"Hot tiles: {len(hot_tiles)}")
         
         return timestamp, img_cv, log_entries
 
-    def match_template(self, img_gray, template):
+    def match_template(self, pyramid, template):
         h, w = template.shape[:2]
         found = None
-        for scale in np.linspace(0.2, 1.0, 20)[::-1]:
-            resized = cv2.resize(img_gray, (int(img_gray.shape[1] * scale), int(img_gray.shape[0] * scale)))
-            r = img_gray.shape[1] / float(resized.shape[1])
+        for index in range(len(pyramid.scales)):
+            resized, r = pyramid.level(index)
             
             if resized.shape[0] < h or resized.shape[1] < w:
                 break
@@ -3,36 +3,102 @@ import cv2
 import json
 import numpy as np
 import os
-import psutil
 import time
-import torch
-from mss import mss
-from PIL import Image
-from torchvision.transforms import Compose, Resize, ToTensor, Normalize
-from win32 import win32gui, win32process
+from concurrent.futures import ThreadPoolExecutor
 
+CHANGE_SIZE = (320, 180)
+CHANGE_GRID = (32, 18)
+CHANGE_NOISE = 30
+
+# Change detection on a small area-averaged frame, heatmap is the percentage of changed pixels per tile
+class ChangeDetector:
+    def __init__(self, size=CHANGE_SIZE, grid=CHANGE_GRID, noise_threshold=CHANGE_NOISE, hot_threshold=5):
+        self.size = size
+        self.grid = grid
+        self.noise_threshold = noise_threshold
+        self.hot_threshold = hot_threshold
+        self.previous = None
+        self.heatmap = None
+        self.hot_tiles = None
+
+    def update(self, img_gray):
+        # Returns (change percentage, hot tiles as (row, col) pairs), (None, None) on the first frame
+        small = cv2.resize(img_gray, self.size, interpolation=cv2.INTER_AREA)
+        result = (None, None)
+        if self.previous is not None:
+            frame_diff = cv2.absdiff(self.previous, small)
+            _, changed = cv2.threshold(frame_diff, self.noise_threshold, 100, cv2.THRESH_BINARY)
+            self.heatmap = cv2.resize(changed.astype(np.float32), self.grid, interpolation=cv2.INTER_AREA)
+            self.hot_tiles = np.argwhere(self.heatmap > self.hot_threshold)
+            result = (float(self.heatmap.mean()), self.hot_tiles)
+        self.previous = small
+        return result
+
+DEPTH_INPUT_SIZE = 256  # MiDaS_small is trained at 256x256
+DEPTH_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+DEPTH_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+# MiDaS_small depth, only on every Nth frame or on frames that changed a lot.
+# output is 'model' (depth at model resolution), 'full' (upsampled to the frame) or [width, height].
+# weights is a TorchScript file of the whole model, loaded without torch.hub so it works offline. Export it once:
+#   model = torch.hub.load("intel-isl/MiDaS", "MiDaS_small").eval()
+#   torch.jit.trace(model, torch.zeros(1, 3, 256, 256)).save("midas_small.pt")
+# Without weights the model comes from torch.hub (repo). That downloads MiDaS, its EfficientNet backbone code
+# and both sets of weights, even from a local MiDaS checkout, unless they are already in the torch hub cache.
 class DepthEstimator:
-    def __init__(self):
+    def __init__(self, every=10, change_threshold=5.0, output='model', batch_size=4, threads=None,
+                 input_size=DEPTH_INPUT_SIZE, repo='intel-isl/MiDaS', weights=None):
+        # torch is only loaded when the depth stage is on
+        import torch
+        if threads:
+            torch.set_num_threads(threads)
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.model = torch.hub.load("intel-isl/MiDaS", "MiDaS_small").to(self.device).eval()
-        self.transform = Compose([
-            Resize((384, 384)),
-            ToTensor(),
-            Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-        ])
-
-    async def estimate_depth(self, img):
+        self.every = every
+        self.change_threshold = change_threshold
+        self.output = output
+        self.batch_size = batch_size
+        self.input_size = input_size
+        self.model = self.load_model(repo, weights).to(self.device).eval()
+        self.frames_seen = 0
+
+    def load_model(self, repo, weights):
+        import torch
+        if weights is not None:
+            return torch.jit.load(weights, map_location="cpu")
+        source = 'local' if os.path.isdir(repo) else 'github'
+        return torch.hub.load(repo, "MiDaS_small", source=source)
+
+    def should_run(self, change_significance):
+        # Every Nth frame starting with the first, plus any frame changing more than change_threshold percent
+        self.frames_seen += 1
+        if self.every and (self.frames_seen - 1) % self.every == 0:
+            return True
+        return self.change_threshold is not None and change_significance >= self.change_threshold
+
+    def prepare(self, img):
         img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        input_batch = self.transform(Image.fromarray(img_rgb)).unsqueeze(0).to(self.device)
-        with torch.no_grad():
+        resized = cv2.resize(img_rgb, (self.input_size, self.input_size), interpolation=cv2.INTER_AREA)
+        return (resized.astype(np.float32) / 255.0 - DEPTH_MEAN) / DEPTH_STD
+
+    def estimate_depth(self, imgs):
+        # One forward pass for all frames, returns a float32 depth map per frame
+        import torch
+        input_batch = torch.from_numpy(np.stack([self.prepare(img) for img in imgs])).permute(0, 3, 1, 2).to(self.device)
+        with torch.inference_mode():
             prediction = self.model(input_batch)
-            prediction = torch.nn.functional.interpolate(
-                prediction.unsqueeze(1),
-                size=img.shape[:2],
-                mode="bicubic",
-                align_corners=False,
-            ).squeeze()
-        return prediction.cpu().numpy()
+            if self.output == 'model':
+                return list(prediction.cpu().numpy())
+            depth_maps = []
+            for i, img in enumerate(imgs):
+                size = img.shape[:2] if self.output == 'full' else (self.output[1], self.output[0])
+                depth = torch.nn.functional.interpolate(
+                    prediction[i:i + 1].unsqueeze(1),
+                    size=size,
+                    mode="bicubic",
+                    align_corners=False,
+                ).squeeze()
+                depth_maps.append(depth.cpu().numpy())
+            return depth_maps
 
 class CameraEstimator:
     async def estimate_camera_params(self, img):
@@ -43,14 +109,36 @@ class CameraEstimator:
             "image_size": (width, height)
         }
 
+def put_latest(queue, item):
+    # Puts without waiting, a full queue drops its oldest item first. Returns the number dropped
+    dropped = 0
+    if queue.full():
+        queue.get_nowait()
+        dropped = 1
+    queue.put_nowait(item)
+    return dropped
+
 class WindowCapture:
     def __init__(self, config_file='config.json'):
         self.load_config(config_file)
         self.templates = self.load_templates()
-        self.depth_estimator = DepthEstimator()
+        # With the stage off torch is never imported
+        self.depth_estimator = DepthEstimator(**self.depth_config) if self.depth_enabled else None
         self.camera_estimator = CameraEstimator()
-        self.sct = mss()
-        self.previous_frame = None
+        # Created by the capture thread, mss handles belong to the thread that made them.
+        # mss, pywin32 and psutil are imported there on the first grab
+        self.sct = None
+        self.win32gui = self.win32process = self.psutil = None
+        self.change_detector = ChangeDetector()
+        self.dropped_frames = 0
+        self.dropped_depth = 0
+        # Created by run(), frames waiting for the depth model
+        self.depth_frames = None
+        # OpenCV releases the GIL, checks and template matches run in parallel threads.
+        # Capture and the torch model get one thread each, they are not used concurrently.
+        self.executor = ThreadPoolExecutor(max_workers=self.analysis_workers)
+        self.capture_executor = ThreadPoolExecutor(max_workers=1)
+        self.depth_executor = ThreadPoolExecutor(max_workers=1)
 
     def load_config(self, config_file):
         with open(config_file, 'r') as f:
@@ -59,6 +147,14 @@ class WindowCapture:
         self.capture_interval = config.get('capture_interval', 0.1)  # Reduced for real-time
         self.template_dir = config.get('template_dir', '.venv/templates')
         self.confidence_threshold = config.get('confidence_threshold', 0.8)
+        self.analysis_workers = config.get('analysis_workers', os.cpu_count() or 4)
+        # Frames waiting for analysis (the oldest is dropped when full) and results waiting to be reported
+        self.queue_size = config.get('queue_size', 1)
+        # DepthEstimator arguments, e.g. {"every": 10, "output": [160, 90], "weights": "midas_small.pt"}.
+        # false, null or "enabled": false turn the stage off
+        depth_config = config.get('depth', {})
+        self.depth_config = dict(depth_config or {})
+        self.depth_enabled = depth_config is not None and depth_config is not False and self.depth_config.pop('enabled', True)
 
     def load_templates(self):
         templates = []
@@ -70,35 +166,68 @@ class WindowCapture:
                     templates.append((filename, template))
         return templates
 
+    async def run_blocking(self, executor, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+    async def timed(self, timings, stage, awaitable):
+        start_time = time.perf_counter()
+        result = await awaitable
+        timings[stage] = (time.perf_counter() - start_time) * 1000
+        return result
+
     async def capture_window(self):
+        return await self.run_blocking(self.capture_executor, self.grab_window)
+
+    def grab_window(self):
+        if self.sct is None:
+            from mss import mss
+            from win32 import win32gui, win32process
+            import psutil
+            self.win32gui, self.win32process, self.psutil = win32gui, win32process, psutil
+            self.sct = mss()
         target_window = self.get_target_window()
         if target_window:
-            left, top, right, bottom = win32gui.GetWindowRect(target_window)
+            left, top, right, bottom = self.win32gui.GetWindowRect(target_window)
             width, height = right - left, bottom - top
             monitor = {"top": top, "left": left, "width": width, "height": height}
             screenshot = self.sct.grab(monitor)
-            img = Image.frombytes("RGB", screenshot.size, screenshot.rgb)
-            return img, left, top
+            img = np.frombuffer(screenshot.raw, dtype=np.uint8).reshape(screenshot.height, screenshot.width, 4)
+            return cv2.cvtColor(img, cv2.COLOR_BGRA2BGR), left, top
         return None, None, None
 
-    async def process_screenshot(self, img, window_left, window_top):
+    async def process_screenshot(self, img_cv, window_left, window_top):
         timestamp = time.time()
-        img_cv = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
-        img_gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY)
+        img_gray = await self.run_blocking(self.executor, cv2.cvtColor, img_cv, cv2.COLOR_BGR2GRAY)
+
+        # Change first, it is cheap and decides whether the frame goes to the depth model
+        timings = {}
+        change_significance, hot_tiles = await self.timed(timings, "change", self.run_blocking(self.executor, self.calculate_change, img_gray))
+        depth_queued = self.depth_frames is not None and self.depth_estimator.should_run(change_significance)
+        if depth_queued:
+            # Depth runs in its own task and is reported when ready, the frame does not wait for it
+            self.dropped_depth += put_latest(self.depth_frames, (timestamp, img_cv))
+
+        # Independent stages run together, a frame takes about as long as its slowest stage
+        health_bars, template_matches, camera_params = await asyncio.gather(
+            self.timed(timings, "health_bars", self.run_blocking(self.executor, self.check_health_bars, img_cv)),
+            self.timed(timings, "templates", self.match_templates(img_gray, window_left, window_top)),
+            self.timed(timings, "camera", self.camera_estimator.estimate_camera_params(img_cv)),
+        )
 
         results = {
             "timestamp": timestamp,
-            "health_bars": await self.check_health_bars(img_cv),
-            "template_matches": await self.match_templates(img_gray, window_left, window_top),
-            "change_significance": await self.calculate_change(img_gray),
-            "depth_map": await self.depth_estimator.estimate_depth(img_cv),
-            "camera_params": await self.camera_estimator.estimate_camera_params(img_cv)
+            "health_bars": health_bars,
+            "template_matches": template_matches,
+            "change_significance": change_significance,
+            "hot_tiles": hot_tiles,
+            "depth_queued": depth_queued,
+            "camera_params": camera_params,
+            "stage_ms": timings,
         }
 
-        self.previous_frame = img_gray
         return results
 
-    async def check_health_bars(self, img_cv):
+    def check_health_bars(self, img_cv):
         health_bars = [
             {"name": "Thirst", "position": (1087, 687)},
             {"name": "Hunger", "position": (1118, 683)},
@@ -129,8 +258,11 @@ class WindowCapture:
 
     async def match_templates(self, img_gray, window_left, window_top):
         matches = {}
-        for template_name, template in self.templates:
-            match_result = await self.match_template(img_gray, template)
+        match_results = await asyncio.gather(*(
+            self.run_blocking(self.executor, self.match_template, img_gray, template)
+            for _, template in self.templates
+        ))
+        for (template_name, _), match_result in zip(self.templates, match_results):
             if match_result:
                 startX, startY, endX, endY, scale, confidence = match_result
                 print(f"Template: {template_name}, Confidence: {confidence:.4f}, "
@@ -146,7 +278,7 @@ class WindowCapture:
                     }
         return matches
 
-    async def match_template(self, img_gray, template):
+    def match_template(self, img_gray, template):
         h, w = template.shape[:2]
         found = None
         for scale in np.linspace(0.2, 1.0, 20)[::-1]:
@@ -169,42 +301,96 @@ class WindowCapture:
             return startX, startY, endX, endY, 1/r, maxVal
         return None
 
-    async def calculate_change(self, img_gray):
-        if self.previous_frame is not None:
-            frame_diff = cv2.absdiff(self.previous_frame, img_gray)
-            _, thresh = cv2.threshold(frame_diff, 30, 255, cv2.THRESH_BINARY)
-            return (np.sum(thresh) / 255) / (thresh.shape[0] * thresh.shape[1]) * 100
-        return 0
+    def calculate_change(self, img_gray):
+        # Frames are analysed one at a time and in order, the detector keeps the previous one
+        change_percentage, hot_tiles = self.change_detector.update(img_gray)
+        return (change_percentage if change_percentage is not None else 0), hot_tiles
 
     def get_target_window(self):
         def enum_windows_callback(hwnd, target_windows):
-            if win32gui.IsWindowVisible(hwnd) and win32gui.GetWindowText(hwnd):
-                _, pid = win32process.GetWindowThreadProcessId(hwnd)
+            if self.win32gui.IsWindowVisible(hwnd) and self.win32gui.GetWindowText(hwnd):
+                _, pid = self.win32process.GetWindowThreadProcessId(hwnd)
                 try:
-                    process = psutil.Process(pid)
+                    process = self.psutil.Process(pid)
                     if process.name().lower() == self.target_window.lower():
                         target_windows.append(hwnd)
-                except psutil.NoSuchProcess:
+                except self.psutil.NoSuchProcess:
                     pass
             return True
 
         target_windows = []
-        win32gui.EnumWindows(enum_windows_callback, target_windows)
+        self.win32gui.EnumWindows(enum_windows_callback, target_windows)
         return target_windows[0] if target_windows else None
 
-    async def run(self):
+## PIPELINE
+# capture -> frames queue -> analysis -> results queue -> report, analysis -> depth frames queue -> depth -> results queue.
+# The next frame is grabbed while the current one is analysed. A full frames or depth frames queue drops
+# its oldest frame, so no stage works through a backlog of stale frames. A full results queue makes the stages wait.
+    async def capture_loop(self, frames):
         while True:
+            start_time = time.perf_counter()
             img, left, top = await self.capture_window()
             if img is not None:
-                results = await self.process_screenshot(img, left, top)
-                print(f"\nProcessed screenshot at {results['timestamp']}")
-                print(f"Health Bars: {results['health_bars']}")
-                print(f"Template Matches: {results['template_matches']}")
-                print(f"Change Significance: {results['change_significance']:.2f}%")
-                depth_map = results['depth_map']
-                print(f"Depth: min={depth_map.min():.2f}, max={depth_map.max():.2f}, "
-                      f"mean={depth_map.mean():.2f}")
-            await asyncio.sleep(self.capture_interval)
+                self.dropped_frames += put_latest(frames, (img, left, top, start_time))
+            await asyncio.sleep(max(0.0, self.capture_interval - (time.perf_counter() - start_time)))
+
+    async def analysis_loop(self, frames, results):
+        while True:
+            img, left, top, capture_time = await frames.get()
+            result = await self.process_screenshot(img, left, top)
+            result["latency_ms"] = (time.perf_counter() - capture_time) * 1000
+            await results.put(result)
+
+    async def depth_loop(self, depth_frames, results):
+        while True:
+            batch = [await depth_frames.get()]
+            # Frames that queued up while the model was busy share one forward pass
+            while len(batch) < self.depth_estimator.batch_size and not depth_frames.empty():
+                batch.append(depth_frames.get_nowait())
+            start_time = time.perf_counter()
+            depth_maps = await self.run_blocking(self.depth_executor, self.depth_estimator.estimate_depth, [img for _, img in batch])
+            depth_ms = (time.perf_counter() - start_time) * 1000
+            for (timestamp, _), depth_map in zip(batch, depth_maps):
+                await results.put({"timestamp": timestamp, "depth_map": depth_map, "batch": len(batch), "depth_ms": depth_ms})
+
+    async def report_loop(self, results):
+        while True:
+            result = await results.get()
+            if "depth_map" in result:
+                depth_map = result['depth_map']
+                print(f"\nDepth for screenshot at {result['timestamp']} ({depth_map.shape[1]}x{depth_map.shape[0]}, "
+                      f"batch of {result['batch']} in {result['depth_ms']:.1f} ms, dropped: {self.dropped_depth}): "
+                      f"min={depth_map.min():.2f}, max={depth_map.max():.2f}, mean={depth_map.mean():.2f}")
+                continue
+            print(f"\nProcessed screenshot at {result['timestamp']}")
+            print(f"Health Bars: {result['health_bars']}")
+            print(f"Template Matches: {result['template_matches']}")
+            print(f"Change Significance: {result['change_significance']:.2f}%")
+            print(f"Hot tiles: {len(result['hot_tiles']) if result['hot_tiles'] is not None else 0}")
+            print(f"Depth queued: {result['depth_queued']}")
+            slowest = max(result['stage_ms'], key=result['stage_ms'].get)
+            print(f"Latency: {result['latency_ms']:.1f} ms (slowest stage: {slowest} {result['stage_ms'][slowest]:.1f} ms), "
+                  f"dropped frames: {self.dropped_frames}")
+
+    async def run(self):
+        frames = asyncio.Queue(maxsize=self.queue_size)
+        results = asyncio.Queue(maxsize=self.queue_size)
+        tasks = [
+            asyncio.create_task(self.capture_loop(frames)),
+            asyncio.create_task(self.analysis_loop(frames, results)),
+            asyncio.create_task(self.report_loop(results)),
+        ]
+        if self.depth_estimator is not None:
+            self.depth_frames = asyncio.Queue(maxsize=self.depth_estimator.batch_size)
+            tasks.append(asyncio.create_task(self.depth_loop(self.depth_frames, results)))
+        try:
+            # Runs until a stage fails or the program is interrupted
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            for executor in (self.capture_executor, self.executor, self.depth_executor):
+                executor.shutdown(wait=False, cancel_futures=True)
 
 async def main():
     window_capture = WindowCapture()